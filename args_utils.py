@@ -13,6 +13,8 @@ def create_argparser():
         warmup=0,
         batch_size=1,
         microbatch=-1,  # -1 disables microbatches
+        max_tokens=-1,  # -1 batches by batch_size, otherwise by padded source+target tokens per batch
+        microbatch_tokens=-1,  # -1 splits by microbatch, otherwise by padded source+target tokens per microbatch
         ema_rate="0.9999",  # comma-separated list of EMA values
         log_interval=50,
         save_interval=25000,
@@ -66,6 +68,12 @@ def additional_args_for_translation():
         generate_by_mix=False,
         generate_by_mix_prob=0.0,
         generate_by_mix_part=1.0,
+        length_bucketing=False,  # batch rows of similar source length together
+        bucket_size=100,  # number of batches sorted together by length_bucketing
+        dynamic_padding=False,  # pad the source to the longest row of the batch instead of sequence_len_src
+        streaming_data=False,  # stream the text files instead of reading them; length_bucketing/max_tokens do not apply
+        shuffle_buffer=10000,  # rows mixed by the streaming dataset when shuffling the train split
+        device_prefetch=True,  # copy the next training batch to the device while the current step runs
     )
 
 
@@ -85,7 +93,7 @@ def model_and_diffusion_defaults():
         class_cond=False,
         diffusion_steps=10000,
         noise_schedule="linear",
-        timestep_respacing="",
+        timestep_respacing="",  # e.g. "200" or "ddim100": sample with fewer steps, works with --time_schedule_path
         use_kl=False,
         predict_xstart=False,
         rescale_timesteps=True,
@@ -112,9 +120,16 @@ def decoding_defaults():
         num_samples=50,
         top_p=0.9,
         out_dir="",
+        output_path="",  # file for the decoded samples (raw ids go next to it); by default named after the model and settings
         model_name_or_path="",
         checkpoint_path="",
         use_ddim=False,
+        ddim_steps=100,  # number of timesteps the DDIM sampler visits when use_ddim is set
+        ddim_eta=0.0,  # DDIM stochasticity, 0 is deterministic
+        early_exit_window=0,  # if > 0, stop sampling a row once its tokens are unchanged for this many steps
+        continuous_batching=False,  # refill finished rows from the request stream instead of sampling batch by batch; ancestral steps only
+        compile_step=False,  # run the ancestral denoising step through torch.compile (inductor); not with continuous_batching (raises)
+        fused_step=False,  # take the ancestral denoising steps in place into preallocated buffers; not with continuous_batching (raises)
         clip_denoised=False,
         batch_size=64,
         mbr_sample=1,
@@ -0,0 +1,313 @@
+"""
+Micro-benchmarks for the sampling hot path.
+
+    python benchmark.py top_p [batch_size] [sequence_len] [channels]
+    python benchmark.py step [batch_size] [sequence_len] [sequence_len_src]
+    python benchmark.py fused [sequence_len] [channels]
+    python benchmark.py compile [batch_size] [sequence_len] [sequence_len_src]
+    python benchmark.py attention [batch_size] [sequence_len] [sequence_len_src]
+    python benchmark.py encode_batch [iupac_text_file] [tokenizer_dir]
+"""
+import sys
+import time
+
+import torch as th
+
+from src.modeling.diffusion import gaussian_diffusion as gd
+from src.modeling.diffusion.gaussian_diffusion import GaussianDiffusion
+from src.modeling.diffusion.respace import SpacedDiffusion, space_timesteps
+
+
+def _time(fn, repeats=50):
+    """Median wall-clock time of `fn()` in milliseconds, synchronizing CUDA around every call."""
+    for _ in range(5):
+        fn()
+    times = []
+    for _ in range(repeats):
+        if th.cuda.is_available():
+            th.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if th.cuda.is_available():
+            th.cuda.synchronize()
+        times.append((time.perf_counter() - start) * 1000)
+    return sorted(times)[len(times) // 2]
+
+
+def _redraw_noise(x, top_p):
+    # the rejection loop p_sample used before the inverse-CDF sampler
+    noise = th.randn_like(x)
+    replace_mask = th.abs(noise) > top_p
+    while replace_mask.any():
+        noise[replace_mask] = th.randn_like(noise[replace_mask])
+        replace_mask = th.abs(noise) > top_p
+    return noise
+
+
+def bench_top_p(batch_size=64, sequence_len=128, channels=128):
+    """
+    Per-step cost of the top_p noise for a range of top_p, for the old rejection loop
+    and GaussianDiffusion._noise_like. Also prints the std of both samples, which
+    should agree since both draw the same truncated normal.
+    """
+    device = "cuda" if th.cuda.is_available() else "cpu"
+    x = th.zeros(batch_size, sequence_len, channels, device=device)
+    print(f"top_p noise, shape {tuple(x.shape)} on {device}")
+    print(f"{'top_p':>6} {'redraw ms':>10} {'inverse cdf ms':>15} {'redraw std':>11} {'inverse cdf std':>16}")
+    for top_p in (0.1, 0.5, 0.9, 1.5, 3.0):
+        redraw = _time(lambda: _redraw_noise(x, top_p))
+        inverse_cdf = _time(lambda: GaussianDiffusion._noise_like(x, top_p))
+        redraw_std = _redraw_noise(x, top_p).std().item()
+        inverse_cdf_std = GaussianDiffusion._noise_like(x, top_p).std().item()
+        print(f"{top_p:>6} {redraw:>10.3f} {inverse_cdf:>15.3f} {redraw_std:>11.4f} {inverse_cdf_std:>16.4f}")
+
+
+def _sampling_setup(batch_size, sequence_len, sequence_len_src, diffusion_steps=2000, device=None):
+    """
+    A randomly initialized model of the size trained by train_scripts/wjm_iupac_smiles.sh
+    (bart-base layout, 512 channels, 8 heads), its diffusion and a batch of sampling
+    model_kwargs with the encoder already run, on `device` (default: cuda if available).
+    """
+    from transformers import BartConfig
+    from src.modeling.predictor.transformer_model import TransformerNetModel_encoder_decoder
+
+    device = device or ("cuda" if th.cuda.is_available() else "cpu")
+    config = BartConfig(dropout=0.0, attention_dropout=0.0, activation_dropout=0.0)
+    model = TransformerNetModel_encoder_decoder(
+        in_channels=512, model_channels=2048, out_channels=512, init_pretrained=False, freeze_embeddings=False,
+        use_pretrained_embeddings=False, num_heads=8, config=config, vocab_size=1000,
+    ).to(device).eval()
+    diffusion = SpacedDiffusion(
+        use_timesteps=space_timesteps(diffusion_steps, [diffusion_steps]), betas=gd.get_named_beta_schedule("sqrt", diffusion_steps),
+        model_mean_type=gd.ModelMeanType.START_X, model_var_type=gd.ModelVarType.FIXED_SMALL, loss_type=gd.LossType.E2E_MSE,
+        rescale_timesteps=True, model_arch="transformer", training_mode="e2e", token_max_length=sequence_len,
+        save_dir=None, pad_tok_id=0, loss_update_granu=20,
+    )
+    x = th.randn(batch_size, sequence_len, model.embedding_dim, device=device)
+    model_kwargs = {
+        "input_ids": th.randint(3, 1000, (batch_size, sequence_len_src), device=device),
+        "attention_mask": th.ones(batch_size, sequence_len_src, dtype=th.long, device=device),
+    }
+    diffusion._prepare_encoder_outputs(model, x, model_kwargs)
+    return model, diffusion, x, model_kwargs
+
+
+def bench_step(batch_size=64, sequence_len=128, sequence_len_src=128):
+    """
+    Cost of one p_sample step with the step-invariant inputs (cross-attention keys and
+    values, expanded encoder mask, timestep embedding table) precomputed once, against
+    recomputing them in every step.
+    """
+    model, diffusion, x, model_kwargs = _sampling_setup(batch_size, sequence_len, sequence_len_src)
+    per_step_kwargs = {key: value for key, value in model_kwargs.items()
+                       if key not in ("cross_attn_key_values", "encoder_attention_mask", "time_embed_table")}
+    t = th.full((batch_size,), 1000, device=x.device)
+    print(f"one denoising step, batch {batch_size}, length {sequence_len}, source length {sequence_len_src} on {x.device}")
+    with th.no_grad():
+        for name, kwargs in (("recomputed", per_step_kwargs), ("precomputed", model_kwargs)):
+            ms = _time(lambda: diffusion.p_sample(model, x, t, clip_denoised=False, model_kwargs=dict(kwargs)), repeats=20)
+            print(f"{name:>12}: {ms:.2f} ms")
+
+
+class _LinearDenoiser(th.nn.Module):
+    """A one-layer stand-in for the model, so the timings are dominated by the sampling update."""
+
+    def __init__(self, channels):
+        super().__init__()
+        self.proj = th.nn.Linear(channels, channels)
+
+    def forward(self, x, timesteps, self_conditions=None):
+        return self.proj(x)
+
+
+def _peak_cpu_memory(fn):
+    """Peak of the tensor memory allocated while `fn()` runs, in MiB, from the profiler's allocation events."""
+    from torch.profiler import profile, ProfilerActivity
+
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return peak / 2 ** 20
+
+
+def bench_fused(sequence_len=128, channels=128, diffusion_steps=2000):
+    """
+    Steps/sec and peak memory of one ancestral step on CPU, p_sample against
+    p_sample_fused into preallocated buffers, for batch sizes 64 to 512.
+    """
+    diffusion = GaussianDiffusion(
+        betas=gd.get_named_beta_schedule("sqrt", diffusion_steps), model_mean_type=gd.ModelMeanType.START_X,
+        model_var_type=gd.ModelVarType.FIXED_SMALL, loss_type=gd.LossType.E2E_MSE, rescale_timesteps=True,
+        model_arch="transformer", training_mode="e2e", token_max_length=sequence_len, save_dir=None,
+        pad_tok_id=0, loss_update_granu=20,
+    )
+    model = _LinearDenoiser(channels).eval()
+    print(f"one ancestral step, length {sequence_len}, channels {channels} on cpu")
+    print(f"{'batch':>6} {'p_sample steps/s':>17} {'fused steps/s':>14} {'p_sample peak MiB':>18} {'fused peak MiB':>15}")
+    with th.no_grad():
+        for batch_size in (64, 128, 256, 512):
+            x = th.randn(batch_size, sequence_len, channels)
+            t = th.full((batch_size,), diffusion_steps // 2)
+            out, noise = th.empty_like(x), th.empty_like(x)
+            kwargs = {"self_conditions": th.zeros_like(x)}
+            step = lambda: diffusion.p_sample(model, x, t, clip_denoised=False, model_kwargs=dict(kwargs))
+            fused_step = lambda: diffusion.p_sample_fused(model, x, t, out, noise, clip_denoised=False,
+                                                          model_kwargs=dict(kwargs))
+            ms, fused_ms = _time(step, repeats=20), _time(fused_step, repeats=20)
+            peak, fused_peak = _peak_cpu_memory(step), _peak_cpu_memory(fused_step)
+            print(f"{batch_size:>6} {1000 / ms:>17.1f} {1000 / fused_ms:>14.1f} {peak:>18.1f} {fused_peak:>15.1f}")
+
+
+def bench_compile(batch_size=16, sequence_len=128, sequence_len_src=128):
+    """
+    One ancestral step of GaussianDiffusion.sample_step_fn in eager mode against the
+    same step compiled by torch.compile with the inductor backend, and the difference
+    between their outputs. Always on CPU, which the inductor backend targets here.
+    """
+    model, diffusion, x, model_kwargs = _sampling_setup(batch_size, sequence_len, sequence_len_src, device="cpu")
+    t = th.full((batch_size,), 1000, device=x.device)
+    inputs = (x, t, th.randn_like(x), th.zeros_like(x), model_kwargs, diffusion._step_coefficients(t, x.dim()))
+    eager = diffusion.sample_step_fn(model, clip_denoised=False)
+    compiled = diffusion.sample_step_fn(model, clip_denoised=False, compile=True)
+    print(f"one denoising step, batch {batch_size}, length {sequence_len}, source length {sequence_len_src} on {x.device}")
+    with th.no_grad():
+        start = time.perf_counter()
+        compiled(*inputs)
+        print(f"compilation: {time.perf_counter() - start:.1f} s")
+        diff = (eager(*inputs)[0] - compiled(*inputs)[0]).abs().max().item()
+        for name, step in (("eager", eager), ("inductor", compiled)):
+            ms = _time(lambda: step(*inputs), repeats=10)
+            print(f"{name:>9}: {ms:.2f} ms, {1000 / ms:.2f} steps/s")
+    print(f"max abs difference of x_(t-1): {diff:.2e}")
+
+
+def _attention_outputs(attention, use_sdpa, hidden_states, key_value_states, attention_mask):
+    """Output and input gradients of `attention` with its scaled_dot_product_attention path on or off."""
+    attention.use_sdpa = use_sdpa
+    hidden_states = hidden_states.detach().requires_grad_()
+    if key_value_states is not None:
+        key_value_states = key_value_states.detach().requires_grad_()
+    output = attention(hidden_states, key_value_states=key_value_states, attention_mask=attention_mask)[0]
+    output.square().sum().backward()
+    grads = [hidden_states.grad] + ([key_value_states.grad] if key_value_states is not None else [])
+    return [output.detach()] + grads
+
+
+def check_sdpa_attention(batch_size=4, sequence_len=32, sequence_len_src=48, embed_dim=512, num_heads=8):
+    """
+    Compare BartAttention with scaled_dot_product_attention against the explicit bmm/softmax
+    implementation: encoder self-attention with padding, decoder self-attention without a
+    mask, cross-attention with a padded source and cross-attention from cached keys and values.
+    """
+    from modeling_bart import BartAttention, _expand_mask
+
+    th.manual_seed(0)
+    attention = BartAttention(embed_dim, num_heads, is_decoder=True)
+    hidden_states = th.randn(batch_size, sequence_len, embed_dim)
+    encoder_states = th.randn(batch_size, sequence_len_src, embed_dim)
+    self_mask = th.ones(batch_size, sequence_len, dtype=th.long)
+    self_mask[0, sequence_len // 2:] = 0
+    source_mask = th.ones(batch_size, sequence_len_src, dtype=th.long)
+    source_mask[1, sequence_len_src // 3:] = 0
+    cases = {
+        "self-attention, padded": (hidden_states, None, _expand_mask(self_mask, th.float32)),
+        "self-attention, no mask": (hidden_states, None, None),
+        "cross-attention, padded": (hidden_states, encoder_states, _expand_mask(source_mask, th.float32, sequence_len)),
+    }
+    worst = 0.0
+    for name, (states, key_value_states, mask) in cases.items():
+        diffs = [(a - b).abs().max().item() for a, b in zip(
+            _attention_outputs(attention, True, states, key_value_states, mask),
+            _attention_outputs(attention, False, states, key_value_states, mask),
+        )]
+        worst = max(worst, *diffs)
+        print(f"{name:>32}: max abs difference of output and gradients {max(diffs):.2e}")
+    with th.no_grad():
+        attention.use_sdpa = False
+        cached = attention(hidden_states, key_value_states=encoder_states)[2]
+        outputs = []
+        for use_sdpa in (True, False):
+            attention.use_sdpa = use_sdpa
+            outputs.append(attention(hidden_states, key_value_states=encoder_states, past_key_value=cached,
+                                     attention_mask=_expand_mask(source_mask, th.float32, sequence_len))[0])
+    diff = (outputs[0] - outputs[1]).abs().max().item()
+    worst = max(worst, diff)
+    print(f"{'cross-attention, cached k/v':>32}: max abs difference of output {diff:.2e}")
+    return worst
+
+
+def bench_attention(batch_size=16, sequence_len=128, sequence_len_src=1024, embed_dim=512, num_heads=8):
+    """
+    Equivalence of the scaled_dot_product_attention path of BartAttention (check_sdpa_attention),
+    then the time and peak memory of one cross-attention layer over a long source with
+    the explicit implementation and with scaled_dot_product_attention.
+    """
+    from modeling_bart import BartAttention, _expand_mask
+
+    worst = check_sdpa_attention()
+    assert worst < 1e-4, worst
+    device = "cuda" if th.cuda.is_available() else "cpu"
+    attention = BartAttention(embed_dim, num_heads, is_decoder=True).to(device).eval()
+    hidden_states = th.randn(batch_size, sequence_len, embed_dim, device=device)
+    encoder_states = th.randn(batch_size, sequence_len_src, embed_dim, device=device)
+    mask = _expand_mask(th.ones(batch_size, sequence_len_src, device=device), th.float32, sequence_len)
+    print(f"cross-attention, batch {batch_size}, target {sequence_len}, source {sequence_len_src}, "
+          f"{num_heads} heads of {embed_dim // num_heads} on {device}")
+    with th.no_grad():
+        past_key_value = attention(hidden_states, key_value_states=encoder_states)[2]
+        for name, use_sdpa in (("bmm + softmax", False), ("sdpa", True)):
+            attention.use_sdpa = use_sdpa
+            layer = lambda: attention(hidden_states, key_value_states=encoder_states, past_key_value=past_key_value,
+                                      attention_mask=mask)
+            ms = _time(layer, repeats=20)
+            if device == "cuda":
+                th.cuda.reset_peak_memory_stats()
+                layer()
+                peak = th.cuda.max_memory_allocated() / 2 ** 20
+            else:
+                peak = _peak_cpu_memory(layer)
+            print(f"{name:>14}: {ms:.2f} ms, peak {peak:.1f} MiB")
+
+
+def check_encode_batch(text_path="example/seed.iupac", tokenizer_dir="./data"):
+    """
+    Compare T5IUPACTokenizer.encode_batch with the per-string tokenizer on the lines of
+    `text_path` plus a few edge cases (spaces, unknown characters, empty text), and time both.
+    """
+    import os.path as pt
+    from iupac_tokenization import T5IUPACTokenizer
+
+    iupac_tokenizer = T5IUPACTokenizer(vocab_file=pt.join(tokenizer_dir, "iupac_spm.model"))
+    with open(text_path, "r") as f:
+        texts = [line.strip("\n") for line in f]
+    texts += ["2-(6-aminopurin-9-yl)-5-(methylsulfanylmethyl)oxolane-3,4-diol", "sodium chloride", "", "  ", "\u00e9\u2192x"]
+    start = time.perf_counter()
+    slow = iupac_tokenizer(texts)["input_ids"]
+    slow_s = time.perf_counter() - start
+    start = time.perf_counter()
+    fast = [encoding.ids for encoding in iupac_tokenizer.encode_batch(texts)]
+    fast_s = time.perf_counter() - start
+    mismatches = [text for text, a, b in zip(texts, slow, fast) if a != b]
+    print(f"encode_batch parity: {len(texts) - len(mismatches)} of {len(texts)} identical, "
+          f"per-string {slow_s:.3f} s, encode_batch {fast_s:.3f} s")
+    for text in mismatches[:10]:
+        print("mismatch:", repr(text))
+    return not mismatches
+
+
+if __name__ == "__main__":
+    if sys.argv[1] == "top_p":
+        bench_top_p(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == "step":
+        bench_step(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == "fused":
+        bench_fused(*[int(arg) for arg in sys.argv[2:4]])
+    elif sys.argv[1] == "compile":
+        bench_compile(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == "attention":
+        bench_attention(*[int(arg) for arg in sys.argv[2:5]])
+    elif sys.argv[1] == "encode_batch":
+        assert check_encode_batch(*sys.argv[2:4])
@@ -1,38 +1,247 @@
 import logging
 import torch
 import pandas as pd
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, IterableDataset, Sampler, get_worker_info
 import torch
 from functools import partial
 from mpi4py import MPI
 import os
 import random
+import time
+import hashlib
+import json
+import concurrent.futures
 import numpy as np
+from src.utils import logger
+from iupac_tokenization import T5IUPACTokenizer
 logging.basicConfig(level=logging.INFO)
 
+# token ids of the memory-mapped corpus format, see `binarize_corpus`
+MMAP_TOKEN_DTYPE = np.int32
+MMAP_OFFSET_DTYPE = np.int64
+
+def get_dataset(iupac_tokenizer, smiles_tokenizer, data_path, args):
+    if has_mmap_corpus(data_path, args.src, args.tgt, iupac_tokenizer, smiles_tokenizer):
+        return TextDataset_translation_mmap(data_path=data_path, source=args.src, target=args.tgt,
+                                            shard=MPI.COMM_WORLD.Get_rank(),
+                                            num_shards=MPI.COMM_WORLD.Get_size())
+    return TextDataset_translation(iupac_tokenizer=iupac_tokenizer,smiles_tokenizer=smiles_tokenizer, data_path=data_path, source=args.src, target=args.tgt,
+                                   shard=MPI.COMM_WORLD.Get_rank(),
+                                   num_shards=MPI.COMM_WORLD.Get_size())
+
+def _count_lines(path, block_size=1 << 24):
+    # the number of lines readlines() returns, counted in binary blocks
+    num_lines, last = 0, b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            num_lines += block.count(b'\n')
+            last = block[-1:]
+    return num_lines + (last != b'\n')
+
+def get_dataset_length(iupac_tokenizer, smiles_tokenizer, data_path, args):
+    """
+    len(get_dataset(...)) without reading the corpus: the row count comes from the offset
+    file of a current binarized corpus or from the line count of the text files.
+    """
+    if has_mmap_corpus(data_path, args.src, args.tgt, iupac_tokenizer, smiles_tokenizer):
+        num_rows = MMapIndexedTokens.num_rows(f'{data_path}.{args.src}')
+    else:
+        num_rows = min(_count_lines(f'{data_path}.{lang}') for lang in (args.src, args.tgt))
+    return num_rows // MPI.COMM_WORLD.Get_size()
+
 def get_dataloader(iupac_tokenizer,smiles_tokenizer, data_path, batch_size, max_seq_len, max_seq_len_src, args):
 
-    dataset = TextDataset_translation(iupac_tokenizer=iupac_tokenizer,smiles_tokenizer=smiles_tokenizer, data_path=data_path, source=args.src, target=args.tgt,
-                                        shard=MPI.COMM_WORLD.Get_rank(),
-                                        num_shards=MPI.COMM_WORLD.Get_size())
-    
+    if args.streaming_data:
+        dataset = TextDataset_translation_stream(iupac_tokenizer=iupac_tokenizer, smiles_tokenizer=smiles_tokenizer,
+                                                 data_path=data_path, source=args.src, target=args.tgt,
+                                                 shard=MPI.COMM_WORLD.Get_rank(),
+                                                 num_shards=MPI.COMM_WORLD.Get_size(),
+                                                 shuffle='train' in data_path,
+                                                 shuffle_buffer=args.shuffle_buffer)
+    else:
+        dataset = get_dataset(iupac_tokenizer, smiles_tokenizer, data_path, args)
+
+    if args.streaming_data:
+        # rows arrive in file order, so there is nothing to sample from; bucketing does not apply
+        batching = dict(batch_size=batch_size, drop_last=True)
+    elif args.max_tokens > 0:
+        batching = dict(batch_sampler=TokenBudgetBatchSampler(
+            np.minimum(dataset.src_lengths(), max_seq_len_src),
+            max_tokens=args.max_tokens,
+            tgt_len=max_seq_len,
+            src_len=None if args.dynamic_padding else max_seq_len_src,
+            shuffle='train' in data_path,
+            bucket_size=args.bucket_size,
+            seed=args.seed,
+        ))
+    elif args.length_bucketing:
+        batching = dict(batch_sampler=LengthBucketBatchSampler(
+            np.minimum(dataset.src_lengths(), max_seq_len_src),
+            batch_size=batch_size,
+            shuffle='train' in data_path,
+            bucket_size=args.bucket_size,
+            seed=args.seed,
+        ))
+    else:
+        batching = dict(batch_size=batch_size, drop_last=True, shuffle='train' in data_path)
+
     dataloader = DataLoader(
         dataset,
-        batch_size=batch_size,  # 20,
-        drop_last=True,
-        shuffle='train' in data_path,
         num_workers=10,
         collate_fn=partial(TextDataset_translation.collate_pad, 
                            args=args,
                            cutoff=max_seq_len, 
                            cutoff_src=max_seq_len_src,
-                           padding_token=iupac_tokenizer.pad_token_id if hasattr(iupac_tokenizer, 'pad_token_id') else iupac_tokenizer.get_vocab()['<pad>']),
+                           padding_token=iupac_tokenizer.pad_token_id if hasattr(iupac_tokenizer, 'pad_token_id') else iupac_tokenizer.get_vocab()['<pad>'],
+                           dynamic_padding=args.dynamic_padding),
+        **batching,
     )
 
     while True:
         for batch in dataloader:
             yield batch
 
+
+class DevicePrefetcher:
+    """
+    Wraps the generator returned by get_dataloader and moves batches to `device`
+    one step ahead: while the caller trains on the current batch, the next one is
+    fetched on a background thread, pinned and copied on a side CUDA stream, so
+    both the loading and the copies overlap with compute.
+
+    Batches come out already on the device, so the microbatch slicing in Trainer
+    only takes views of them. The time spent waiting for the current batch is
+    logged as `data_wait`.
+    """
+
+    def __init__(self, data, device) -> None:
+        self.data = data
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(self.device) if self.device.type == 'cuda' else None
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._next = None
+
+    def _stage(self):
+        batch, cond = next(self.data)
+        if self.stream is None:
+            return {k: v.to(self.device) for k, v in batch.items()}, cond
+        with torch.cuda.stream(self.stream):
+            return {k: v.pin_memory().to(self.device, non_blocking=True) for k, v in batch.items()}, cond
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        if self._next is None:
+            self._next = self._executor.submit(self._stage)
+        batch, cond = self._next.result()
+        logger.logkv_mean("data_wait", time.time() - start)
+        if self.stream is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            for v in batch.values():
+                # the tensors were allocated on the side stream but are used on this one
+                v.record_stream(current)
+        # only queued after the wait above, so its copies are not part of this batch's
+        self._next = self._executor.submit(self._stage)
+        return batch, cond
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batches rows of similar source length together, so that dynamic padding has
+    little to pad.
+
+    The row order is shuffled, cut into pools of `batch_size * bucket_size` rows,
+    every pool is sorted by length and split into batches, and the batches are
+    shuffled again. Without `shuffle` the pools are taken in dataset order and the
+    batches are kept in the order they were formed.
+    """
+
+    def __init__(self, lengths, batch_size: int, shuffle: bool, bucket_size: int = 100,
+                 drop_last: bool = True, seed: int = 0) -> None:
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+        self._cached_batches = None
+
+    def _epoch_batches(self):
+        # the batches of the epoch about to be iterated, formed once per epoch
+        if self._cached_batches is None or self._cached_batches[0] != self.epoch:
+            self._cached_batches = (self.epoch, self._batches())
+        return self._cached_batches[1]
+
+    def _batches(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        order = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        pool_size = self.batch_size * self.bucket_size
+        batches = []
+        for start in range(0, len(order), pool_size):
+            pool = order[start:start + pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(self._split_pool(pool))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def _split_pool(self, pool):
+        return [pool[i:i + self.batch_size] for i in range(0, len(pool), self.batch_size)]
+
+    def __iter__(self):
+        batches = self._epoch_batches()
+        self.epoch += 1
+        for batch in batches:
+            yield batch.tolist()
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+
+class TokenBudgetBatchSampler(LengthBucketBatchSampler):
+    """
+    Length-bucketed batches holding at most `max_tokens` padded source+target tokens
+    each, so short molecules make large batches and long ones small batches.
+
+    A batch of n rows costs n * (src_len + tgt_len), where src_len is the longest
+    source row of the batch, or the fixed `src_len` when the source is not padded
+    dynamically. A row that alone exceeds the budget still gets a batch of its own.
+    """
+
+    def __init__(self, lengths, max_tokens: int, tgt_len: int, src_len=None, shuffle: bool = True,
+                 bucket_size: int = 100, seed: int = 0) -> None:
+        lengths = np.asarray(lengths)
+        mean_row_tokens = (src_len if src_len is not None else max(lengths.mean(), 1)) + tgt_len
+        super().__init__(lengths, batch_size=max(int(max_tokens // mean_row_tokens), 1), shuffle=shuffle,
+                         bucket_size=bucket_size, drop_last=False, seed=seed)
+        self.max_tokens = max_tokens
+        self.tgt_len = tgt_len
+        self.src_len = src_len
+
+    def _split_pool(self, pool):
+        batches, start = [], 0
+        src_len = self.lengths[pool] if self.src_len is None else np.full(len(pool), self.src_len)
+        # the pool is sorted by length, so the last row of a batch is its longest
+        for end in range(1, len(pool) + 1):
+            if end - start > 1 and (end - start) * (src_len[end - 1] + self.tgt_len) > self.max_tokens:
+                batches.append(pool[start:end - 1])
+                start = end - 1
+        if start < len(pool):
+            batches.append(pool[start:])
+        return batches
+
+    def __len__(self) -> int:
+        # the number of batches of the epoch that __iter__ yields next
+        return len(self._epoch_batches())
+
 class TextDataset(Dataset):
     def __init__(
         self,
@@ -165,25 +374,16 @@ class TextDataset_translation(TextDataset):
         print('examples src', self.src_text[0])
         print('examples tgt', self.tgt_text[0])
         
-        # check if iupac_tokenizer has a method 'encode_batch'
-        if hasattr(self.iupac_tokenizer, 'encode_batch'):
-
-            encoded_input_src = self.iupac_tokenizer.encode_batch(self.src_text)
-            self.input_ids_src = [x.ids for x in encoded_input_src]
-
-            encoded_input_tgt = self.smiles_tokenizer.encode_batch(self.tgt_text)
-            self.input_ids_tgt = [x.ids for x in encoded_input_tgt]
+        # each side uses its tokenizer's encode_batch when it has one
+        self.input_ids_src = _encode(self.iupac_tokenizer, self.src_text, num_threads=-1)
+        self.input_ids_tgt = _encode(self.smiles_tokenizer, self.tgt_text, num_threads=-1)
         
-        else:
-
-            encoded_input_src = self.iupac_tokenizer(self.src_text)
-            self.input_ids_src = encoded_input_src["input_ids"]
+        # keep the ids packed, collate_pad gathers them with one copy per batch
+        self.input_ids_src = PackedTokens.from_lists(self.input_ids_src)
+        self.input_ids_tgt = PackedTokens.from_lists(self.input_ids_tgt)
 
-            encoded_input_tgt = self.smiles_tokenizer(self.tgt_text)
-            self.input_ids_tgt = encoded_input_tgt["input_ids"]
-        
-        count_length_src = np.mean([len(item) for item in self.input_ids_src])
-        count_length_tgt = np.mean([len(item) for item in self.input_ids_tgt])
+        count_length_src = self.input_ids_src.lengths().mean()
+        count_length_tgt = self.input_ids_tgt.lengths().mean()
 
         print(f'average number of tokens in source {count_length_src}')
         print(f'average number of tokens in target {count_length_tgt}')
@@ -191,6 +391,9 @@ class TextDataset_translation(TextDataset):
     def __len__(self) -> int:
         return len(self.src_text)
 
+    def src_lengths(self):
+        return self.input_ids_src.lengths()
+
     def __getitem__(self, i):
         out_dict = {
             "encoder_input_ids": self.input_ids_src[i],
@@ -199,24 +402,364 @@ class TextDataset_translation(TextDataset):
         return out_dict
 
     @staticmethod
-    def collate_pad(batch, args, cutoff: int, cutoff_src: int, padding_token: int):
+    def collate_pad(batch, args, cutoff: int, cutoff_src: int, padding_token: int, dynamic_padding: bool = False):
+        """
+        Pad the target to `cutoff` and the source to `cutoff_src`, or with
+        `dynamic_padding` only to the longest source row of the batch.
+        """
         max_token_len_src, max_token_len_tgt = cutoff_src, cutoff
         num_elems = len(batch)
+        rows_src = [item["encoder_input_ids"] for item in batch]
+        rows_tgt = [item["decoder_input_ids"] for item in batch]
+        if dynamic_padding:
+            max_token_len_src = min(cutoff_src, max(len(row) for row in rows_src))
 
-        tokens_src = torch.ones(num_elems, max_token_len_src).long() * padding_token
-        tokens_mask_src = torch.zeros(num_elems, max_token_len_src).long()
-
-        tokens_tgt = torch.ones(num_elems, max_token_len_tgt).long() * padding_token
-        tokens_mask_tgt = torch.zeros(num_elems, max_token_len_tgt).long()
-
-        for i in range(num_elems):
-            toks_src = batch[i]["encoder_input_ids"][:max_token_len_src]
-            toks_tgt = batch[i]["decoder_input_ids"][:max_token_len_tgt]
-            l_s, l_t = len(toks_src), len(toks_tgt)
-            tokens_src[i, :l_s] = torch.LongTensor(toks_src)
-            tokens_tgt[i, :l_t] = torch.LongTensor(toks_tgt)
-            tokens_mask_src[i, :l_s] = 1
-            tokens_mask_tgt[i, :] = 1
+        tokens_src, tokens_mask_src = _pad_rows(rows_src, max_token_len_src, padding_token)
+        tokens_tgt, _ = _pad_rows(rows_tgt, max_token_len_tgt, padding_token)
+        tokens_mask_tgt = torch.ones(num_elems, max_token_len_tgt).long()
 
         return {"input_ids": tokens_src, "attention_mask": tokens_mask_src, 
                     'decoder_input_ids': tokens_tgt, 'decoder_attention_mask': tokens_mask_tgt}, None
+
+
+class TextDataset_translation_stream(IterableDataset):
+    """
+    TextDataset_translation that streams the parallel files instead of reading them.
+
+    Line i goes to DataLoader worker `i % (num_shards * num_workers)` across all ranks,
+    so every worker reads both files in lockstep and skips the lines of the others
+    without keeping them. Kept lines are tokenized in groups of `tokenize_batch_size`
+    inside the worker and, for training, mixed through a buffer of `shuffle_buffer`
+    rows, so memory stays bounded by these two sizes rather than the corpus size.
+    """
+
+    def __init__(
+        self,
+        iupac_tokenizer,
+        smiles_tokenizer,
+        data_path: str,
+        source,
+        target,
+        shard,
+        num_shards,
+        shuffle: bool = False,
+        shuffle_buffer: int = 10000,
+        tokenize_batch_size: int = 1000,
+        ) -> None:
+        super().__init__()
+        self.data_path = data_path
+        self.iupac_tokenizer = iupac_tokenizer
+        self.smiles_tokenizer = smiles_tokenizer
+        self.src = source
+        self.tgt = target
+        self.shard = shard
+        self.num_shards = num_shards
+        self.shuffle = shuffle
+        self.shuffle_buffer = shuffle_buffer
+        self.tokenize_batch_size = tokenize_batch_size
+        print(f"Streaming data from {self.data_path} (shard {self.shard} of {self.num_shards})")
+
+    def _lines(self, offset, stride):
+        with open(self.data_path+'.'+self.src, 'r') as fsrc, open(self.data_path+'.'+self.tgt, 'r') as ftgt:
+            for i, (src, tgt) in enumerate(zip(fsrc, ftgt)):
+                if i % stride == offset:
+                    yield src.strip('\n'), tgt.strip('\n')
+
+    def _examples(self, offset, stride):
+        pairs = []
+        for pair in self._lines(offset, stride):
+            pairs.append(pair)
+            if len(pairs) == self.tokenize_batch_size:
+                yield from self._encode_pairs(pairs)
+                pairs = []
+        if pairs:
+            yield from self._encode_pairs(pairs)
+
+    def _encode_pairs(self, pairs):
+        src_text, tgt_text = zip(*pairs)
+        for src_ids, tgt_ids in zip(_encode(self.iupac_tokenizer, list(src_text)),
+                                    _encode(self.smiles_tokenizer, list(tgt_text))):
+            yield {"encoder_input_ids": src_ids, "decoder_input_ids": tgt_ids}
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id, num_workers = (0, 1) if worker_info is None else (worker_info.id, worker_info.num_workers)
+        examples = self._examples(offset=self.shard * num_workers + worker_id, stride=self.num_shards * num_workers)
+        if not self.shuffle:
+            yield from examples
+            return
+
+        # the worker seed changes every epoch, so the buffer order does too
+        rng = random.Random(worker_info.seed if worker_info is not None else random.getrandbits(64))
+        buffer = []
+        for example in examples:
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(example)
+                continue
+            i = rng.randrange(len(buffer))
+            yield buffer[i]
+            buffer[i] = example
+        rng.shuffle(buffer)
+        yield from buffer
+
+
+def _pad_rows(rows, width: int, padding_token: int):
+    """
+    Stack rows of token ids into a (len(rows), width) LongTensor, truncating rows
+    longer than `width` and padding the others with `padding_token`, plus the matching
+    attention mask. The rows are concatenated once and scattered through a boolean
+    mask instead of being copied one by one.
+    """
+    lengths = np.fromiter((len(row) for row in rows), dtype=np.int64, count=len(rows))
+    flat = np.concatenate([np.asarray(row, dtype=np.int64) for row in rows]) if lengths.sum() else np.zeros(0, dtype=np.int64)
+    # position of every token inside its row, tokens past `width` are dropped
+    positions = np.arange(len(flat)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    mask = np.arange(width) < np.minimum(lengths, width)[:, None]
+    tokens = np.full((len(rows), width), padding_token, dtype=np.int64)
+    tokens[mask] = flat[positions < width]
+    return torch.from_numpy(tokens), torch.from_numpy(mask.astype(np.int64))
+
+
+class PackedTokens:
+    """
+    Rows of token ids stored back to back in `tokens`, with the N+1 row offsets into
+    it in `offsets`. Rows are returned as views, not copies.
+    """
+
+    def __init__(self, tokens, offsets) -> None:
+        self.tokens = tokens
+        self.offsets = offsets
+
+    @classmethod
+    def from_lists(cls, input_ids):
+        lengths = np.fromiter((len(ids) for ids in input_ids), dtype=MMAP_OFFSET_DTYPE, count=len(input_ids))
+        tokens = np.fromiter((tok for ids in input_ids for tok in ids), dtype=MMAP_TOKEN_DTYPE,
+                             count=int(lengths.sum()))
+        return cls(tokens, np.concatenate([[0], np.cumsum(lengths)]).astype(MMAP_OFFSET_DTYPE))
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def __getitem__(self, i):
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+
+class MMapIndexedTokens(PackedTokens):
+    """
+    Read-only view of one side of a binarized corpus: `path.bin` holds the token ids
+    of all rows back to back and `path.idx` holds the N+1 row offsets into it.
+    Both files are memory-mapped, so rows are only paged in when they are read.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        super().__init__(tokens=np.memmap(path + '.bin', dtype=MMAP_TOKEN_DTYPE, mode='r'),
+                         offsets=np.memmap(path + '.idx', dtype=MMAP_OFFSET_DTYPE, mode='r'))
+
+    @staticmethod
+    def num_rows(path: str) -> int:
+        return os.path.getsize(path + '.idx') // np.dtype(MMAP_OFFSET_DTYPE).itemsize - 1
+
+
+class TextDataset_translation_mmap(TextDataset_translation):
+    """
+    TextDataset_translation over a corpus written by `binarize_translation_corpus`.
+
+    Nothing is read at construction time: the shard bounds come from the size of the
+    offset files and the memory maps are opened lazily, so every DataLoader worker
+    maps the files itself instead of receiving a pickled copy of the corpus.
+    """
+
+    def __init__(
+        self,
+        data_path: str,
+        source,
+        target,
+        shard,
+        num_shards,
+        ) -> None:
+        self.data_path = data_path
+        self.shard = shard
+        self.src = source
+        self.tgt = target
+        self.num_shards = num_shards
+        self._src_tokens = None
+        self._tgt_tokens = None
+
+        num_rows = MMapIndexedTokens.num_rows(self.data_path+'.'+self.src)
+        num_rows_tgt = MMapIndexedTokens.num_rows(self.data_path+'.'+self.tgt)
+        if num_rows != num_rows_tgt:
+            raise ValueError(f"{self.data_path}: {num_rows} {self.src} rows but {num_rows_tgt} {self.tgt} rows")
+
+        self.bos_idx = (num_rows // self.num_shards) * self.shard
+        self.eos_idx = (num_rows // self.num_shards) * (self.shard+1)
+        print(f"Memory-mapping {self.eos_idx - self.bos_idx} of {num_rows} sentences from {self.data_path}")
+
+    def _open(self):
+        if self._src_tokens is None:
+            self._src_tokens = MMapIndexedTokens(self.data_path+'.'+self.src)
+            self._tgt_tokens = MMapIndexedTokens(self.data_path+'.'+self.tgt)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_src_tokens'] = state['_tgt_tokens'] = None
+        return state
+
+    def __len__(self) -> int:
+        return self.eos_idx - self.bos_idx
+
+    def src_lengths(self):
+        offsets = np.memmap(self.data_path+'.'+self.src+'.idx', dtype=MMAP_OFFSET_DTYPE, mode='r')
+        return np.diff(offsets[self.bos_idx:self.eos_idx + 1])
+
+    def __getitem__(self, i):
+        self._open()
+        out_dict = {
+            "encoder_input_ids": self._src_tokens[self.bos_idx + i],
+            "decoder_input_ids": self._tgt_tokens[self.bos_idx + i],
+        }
+        return out_dict
+
+
+def tokenizer_fingerprint(tokenizer):
+    """sha1 of the tokenizer's class and vocabulary, recorded with a binarized corpus."""
+    vocab = sorted(tokenizer.get_vocab().items())
+    return hashlib.sha1(json.dumps([type(tokenizer).__name__, vocab]).encode()).hexdigest()
+
+
+def _text_file_stat(text_path):
+    if not os.path.exists(text_path):
+        return None
+    stat = os.stat(text_path)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def is_mmap_corpus_current(path, tokenizer=None):
+    """
+    Whether `path.bin` / `path.idx` exist and were binarized from the current `path` text
+    file (same size and modification time, if the text file is there) with `tokenizer`
+    (same fingerprint, if given), according to the `path.meta.json` written with them.
+    """
+    if not all(os.path.exists(path + ext) for ext in ('.bin', '.idx', '.meta.json')):
+        return False
+    with open(path + '.meta.json') as f:
+        meta = json.load(f)
+    text_stat = _text_file_stat(path)
+    if text_stat is not None and meta.get('text') != text_stat:
+        logger.log(f'{path}.bin/.idx are older than {path}, reading the text file instead')
+        return False
+    if tokenizer is not None and meta.get('tokenizer') != tokenizer_fingerprint(tokenizer):
+        logger.log(f'{path}.bin/.idx were binarized with another tokenizer, reading the text file instead')
+        return False
+    return True
+
+
+def has_mmap_corpus(data_path, source, target, source_tokenizer=None, target_tokenizer=None):
+    return (is_mmap_corpus_current(f'{data_path}.{source}', source_tokenizer)
+            and is_mmap_corpus_current(f'{data_path}.{target}', target_tokenizer))
+
+
+def _encode(tokenizer, texts, num_threads=1):
+    """
+    Token ids of `texts`. `num_threads` goes to T5IUPACTokenizer.encode_batch; keep it at
+    1 in data loader and process pool workers, which already run one per core.
+    """
+    if isinstance(tokenizer, T5IUPACTokenizer):
+        return [x.ids for x in tokenizer.encode_batch(texts, num_threads=num_threads)]
+    if hasattr(tokenizer, 'encode_batch'):
+        return [x.ids for x in tokenizer.encode_batch(texts)]
+    return tokenizer(texts)["input_ids"]
+
+
+class MMapCorpusWriter:
+    """
+    Appends rows of token ids to `out_path.bin` / `out_path.idx`.
+
+    Both files are written under a temporary name and only renamed by `close`, so an
+    interrupted run never leaves a corpus that get_dataloader would pick up. `close`
+    then writes `out_path.meta.json` with the size and modification time of the text
+    file the rows come from (`text_path`, by default `out_path` itself) and the
+    fingerprint of `tokenizer`, which has_mmap_corpus checks before using the corpus;
+    the text file must be complete by then.
+    """
+
+    def __init__(self, out_path: str, tokenizer=None, text_path=None) -> None:
+        self.out_path = out_path
+        self.tokenizer = tokenizer
+        self.text_path = text_path if text_path is not None else out_path
+        self.num_rows = 0
+        self.num_tokens = 0
+        self._fbin = open(out_path + '.bin.tmp', 'wb')
+        self._fidx = open(out_path + '.idx.tmp', 'wb')
+        np.zeros(1, dtype=MMAP_OFFSET_DTYPE).tofile(self._fidx)
+
+    def add_packed(self, tokens, lengths):
+        """Append rows given as their concatenated ids and the length of each row."""
+        lengths = np.asarray(lengths, dtype=MMAP_OFFSET_DTYPE)
+        np.asarray(tokens, dtype=MMAP_TOKEN_DTYPE).tofile(self._fbin)
+        (self.num_tokens + np.cumsum(lengths)).tofile(self._fidx)
+        self.num_rows += len(lengths)
+        self.num_tokens += int(lengths.sum())
+
+    def add(self, input_ids):
+        """Append rows given as a list of id lists."""
+        lengths = np.fromiter((len(ids) for ids in input_ids), dtype=MMAP_OFFSET_DTYPE, count=len(input_ids))
+        tokens = np.fromiter((tok for ids in input_ids for tok in ids), dtype=MMAP_TOKEN_DTYPE,
+                             count=int(lengths.sum()))
+        self.add_packed(tokens, lengths)
+
+    def close(self):
+        self._fbin.close()
+        self._fidx.close()
+        os.replace(self.out_path + '.bin.tmp', self.out_path + '.bin')
+        os.replace(self.out_path + '.idx.tmp', self.out_path + '.idx')
+        meta = {'text': _text_file_stat(self.text_path),
+                'tokenizer': tokenizer_fingerprint(self.tokenizer) if self.tokenizer is not None else None}
+        with open(self.out_path + '.meta.json.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(self.out_path + '.meta.json.tmp', self.out_path + '.meta.json')
+
+
+def binarize_corpus(tokenizer, text_path, out_path, chunk_size=100000):
+    """
+    Tokenize `text_path` one line per row into `out_path.bin` / `out_path.idx`.
+
+    The file is streamed in chunks of `chunk_size` lines, so memory does not grow with
+    the corpus.
+    """
+    writer = MMapCorpusWriter(out_path, tokenizer, text_path)
+    with open(text_path, 'r') as fin:
+        while True:
+            lines = [line.strip('\n') for _, line in zip(range(chunk_size), fin)]
+            if not lines:
+                break
+            writer.add(_encode(tokenizer, lines, num_threads=-1))
+            print(f'{text_path}: binarized {writer.num_rows} sentences')
+    writer.close()
+    print(f'average number of tokens in {text_path} {writer.num_tokens / max(writer.num_rows, 1)}')
+    return writer.num_rows
+
+
+def binarize_translation_corpus(iupac_tokenizer, smiles_tokenizer, data_path, source, target, chunk_size=100000):
+    """
+    Write the memory-mapped corpus read by TextDataset_translation_mmap next to the
+    `data_path.source` / `data_path.target` text files, tokenizing the source side with
+    the IUPAC tokenizer and the target side with the SMILES tokenizer like TextDataset_translation.
+    """
+    num_src = binarize_corpus(iupac_tokenizer, data_path+'.'+source, data_path+'.'+source, chunk_size)
+    num_tgt = binarize_corpus(smiles_tokenizer, data_path+'.'+target, data_path+'.'+target, chunk_size)
+    assert num_src == num_tgt, f'{data_path}: {num_src} {source} rows but {num_tgt} {target} rows'
+
+
+if __name__ == "__main__":
+    import sys
+    from tokenizer_utils import create_iupac_smiles_tokenizer
+
+    if sys.argv[1] == "binarize":
+        # python dataloader_utils.py binarize ./data/wjm14/train iupac smiles
+        iupac_tokenizer, smiles_tokenizer = create_iupac_smiles_tokenizer(return_pretokenized=True, path=None)
+        binarize_translation_corpus(iupac_tokenizer, smiles_tokenizer, data_path=sys.argv[2],
+                                    source=sys.argv[3], target=sys.argv[4])
@@ -13,7 +13,7 @@ from src.utils import dist_util, logger
 from args_utils import *
 from model_utils import create_model_and_diffusion
 from args_utils import create_argparser, args_to_dict, model_and_diffusion_defaults
-from tokenizer_utils import create_tokenizer
+from tokenizer_utils import create_iupac_smiles_tokenizer, batch_decode
 import dataloader_utils
 from mpi4py import MPI
 
@@ -34,6 +34,7 @@ def main():
     training_args = read_training_args(config_path)
     training_args["batch_size"] = args.batch_size
     training_args["diffusion_steps"] = args.diffusion_steps
+    training_args["timestep_respacing"] = args.timestep_respacing
     training_args['model_name_or_path'] = args.model_name_or_path
     training_args["clamp"] = args.clamp
     training_args['out_dir'] = args.out_dir
@@ -46,9 +47,30 @@ def main():
     training_args['generate_by_mix'] = args.generate_by_mix
     training_args['time_schedule_path'] = args.time_schedule_path
     training_args['seed'] = args.seed
+    training_args['length_bucketing'] = args.length_bucketing
+    training_args['dynamic_padding'] = args.dynamic_padding
+    training_args['max_tokens'] = args.max_tokens
+    training_args['streaming_data'] = args.streaming_data
+    training_args['use_ddim'] = args.use_ddim
+    training_args['ddim_steps'] = args.ddim_steps
+    training_args['ddim_eta'] = args.ddim_eta
+    training_args['early_exit_window'] = args.early_exit_window
+    training_args['continuous_batching'] = args.continuous_batching
+    training_args['compile_step'] = args.compile_step
+    training_args['fused_step'] = args.fused_step
+    training_args['output_path'] = args.output_path
     
     args.__dict__.update(training_args)
     args.sigma_small = True
+    if args.continuous_batching:
+        # p_sample_loop_continuous only takes plain ancestral steps
+        unsupported = [flag for flag, value in (
+            ("--use_ddim", args.use_ddim), ("--early_exit_window", args.early_exit_window > 0),
+            ("--compile_step", args.compile_step), ("--fused_step", args.fused_step),
+            ("--generate_by_q", args.generate_by_q), ("--generate_by_mix", args.generate_by_mix),
+        ) if value]
+        if unsupported:
+            raise ValueError(f"--continuous_batching does not support {', '.join(unsupported)}")
 
         
     logger.info(f"Init pretrained = {args.init_pretrained}")
@@ -56,13 +78,14 @@ def main():
     logger.info(f"Use pretrained embeddings = {args.use_pretrained_embeddings}")
     logger.info(f"Use pretrained embeddings = {args.use_pretrained_tokenizer}")
     
-    tokenizer = create_tokenizer(return_pretokenized=args.use_pretrained_tokenizer,
-                                 path=f"data/{args.dataset}/",
-                                 tokenizer_type='byte-level',
-                                 tokenizer_ckpt=args.pretrained_tokenizer)
+    iupac_tokenizer, smiles_tokenizer = create_iupac_smiles_tokenizer(return_pretokenized=True,
+                                                                      path=f"data/{args.dataset}/",
+                                                                      tokenizer_ckpt='./data')
+    # TextDataset_translation encodes the target side with the SMILES tokenizer
+    tokenizer = smiles_tokenizer
     
     model, diffusion = create_model_and_diffusion(
-        pad_tok_id=tokenizer.pad_token_id if hasattr(tokenizer, 'pad_token_id') else tokenizer.get_vocab()['<pad>'],
+        pad_tok_id=iupac_tokenizer.pad_token_id if hasattr(iupac_tokenizer, 'pad_token_id') else iupac_tokenizer.get_vocab()['<pad>'],
         resume_checkpoint=args.resume_checkpoint, **args_to_dict(args, model_and_diffusion_defaults().keys())
     )
 
@@ -72,7 +95,8 @@ def main():
 
     print('data path', args.val_txt_path)
     val_dataloader = dataloader_utils.get_dataloader(
-        tokenizer=tokenizer,
+        iupac_tokenizer=iupac_tokenizer,
+        smiles_tokenizer=smiles_tokenizer,
         args=args,
         data_path=args.val_txt_path,
         batch_size=args.batch_size,
@@ -81,9 +105,7 @@ def main():
     )
 
     if args.num_samples <= 0:
-        args.num_samples = len(dataloader_utils.TextDataset_translation(tokenizer=tokenizer, data_path=args.val_txt_path, source=args.src, target=args.tgt,
-                                                                        shard=MPI.COMM_WORLD.Get_rank(),
-                                                                        num_shards=MPI.COMM_WORLD.Get_size()))
+        args.num_samples = dataloader_utils.get_dataset_length(iupac_tokenizer, smiles_tokenizer, args.val_txt_path, args)
         logger.log(f"sample count is {args.num_samples}")
     pytorch_total_params = sum(p.numel() for p in model.parameters())
     logger.log(f"the parameter count is {pytorch_total_params}")
@@ -97,10 +119,17 @@ def main():
     logger.log(f"Clamping is set to {args.clamp}")
     all_samples = []
     ground_true_samples = []
-    while len(all_samples) * args.batch_size < args.num_samples:
+    num_created = 0
+    if args.continuous_batching:
+        cands, ground_true = sample_continuous(args, model, diffusion, val_dataloader)
+        all_samples = [sample.cpu().numpy() for sample in all_gather_rows(cands)]
+        ground_true_samples = [sample.cpu().numpy() for sample in all_gather_rows(ground_true)]
+        num_created = args.num_samples
+    while num_created < args.num_samples:
         batch, _ = next(val_dataloader)
         model_kwargs = {key:item.to(dist_util.dev()) for key, item in batch.items() if 'decoder' not in key}
-        sample_shape = (args.batch_size, args.sequence_len, model.input_transformers.shared.weight.shape[1])
+        # with --max_tokens the number of rows changes from batch to batch
+        sample_shape = (batch['input_ids'].shape[0], args.sequence_len, model.input_transformers.shared.weight.shape[1])
         print('sample_shape', sample_shape)
         sample = diffusion.p_sample_loop(
                 model,
@@ -117,40 +146,37 @@ def main():
                 generate_by_mix=args.generate_by_mix,
                 generate_by_mix_prob=args.generate_by_mix_prob,
                 generate_by_mix_part=args.generate_by_mix_part,
+                use_ddim=args.use_ddim,
+                ddim_steps=args.ddim_steps,
+                ddim_eta=args.ddim_eta,
+                early_exit_window=args.early_exit_window,
+                compile_step=args.compile_step,
+                fused_step=args.fused_step,
             )
 
         logits = model.get_logits(sample)  # bsz, seqlen, vocab
-        cands = th.topk(logits, k=1, dim=-1).indices.squeeze()
+        cands = th.topk(logits, k=1, dim=-1).indices.squeeze(-1)
         if args.decoder_attention_mask:
             cands[model_kwargs['decoder_attention_mask']==0] = 1
 
-        gathered_samples = [th.zeros_like(cands) for _ in range(dist.get_world_size())]
-        dist.all_gather(gathered_samples, cands)  # gather not supported with NCCL
+        gathered_samples = all_gather_rows(cands)
         all_samples.extend([sample.cpu().numpy() for sample in gathered_samples])
         print('number of sample', len(all_samples), all_samples[0].shape)
 
         batch['decoder_input_ids'] = batch['decoder_input_ids'].to(dist_util.dev())
-        gathered_ground_true_sample = [th.zeros_like(batch['decoder_input_ids']) for _ in range(dist.get_world_size())]
-        dist.all_gather(gathered_ground_true_sample, batch['decoder_input_ids'])
+        gathered_ground_true_sample = all_gather_rows(batch['decoder_input_ids'])
         ground_true_samples.extend([sample.cpu().numpy() for sample in gathered_ground_true_sample])
 
-        logger.log(f"created {len(all_samples) * args.batch_size} samples")
+        num_created += sum(sample.shape[0] for sample in gathered_samples)
+        logger.log(f"created {num_created} samples")
 
     cands = np.concatenate(all_samples, axis=0)
     cands = cands[: args.num_samples]
 
-    decoded_sentences = []
-    for seq in cands:
-        seq = seq[seq>2]
-        decoded_sentence = tokenizer.decode(seq.tolist(), skip_special_tokens=True)
-        decoded_sentences.append(decoded_sentence)
+    decoded_sentences = batch_decode(tokenizer, cands)
     
-    ground_true_sentences = []
     ground_true_samples = np.concatenate(ground_true_samples, axis=0)[: args.num_samples]
-    for seq in ground_true_samples:
-        seq = seq[seq>2]
-        ground_true_sentence = tokenizer.decode(seq.squeeze().tolist(), skip_special_tokens=True)
-        ground_true_sentences.append(ground_true_sentence)
+    ground_true_sentences = batch_decode(tokenizer, ground_true_samples)
 
     dist.barrier()
     logger.log("sampling complete")
@@ -162,6 +188,69 @@ def main():
                   raw_gt_sentences=ground_true_samples,)
 
 
+def sample_continuous(args, model, diffusion, val_dataloader):
+    """
+    Generate this rank's share of `num_samples` with diffusion.p_sample_loop_continuous:
+    the validation batches are split into single-row requests that refill the
+    `batch_size` slots as they free up. Returns the token ids of the samples and of
+    the references, in dataloader order.
+    """
+    num_rows = -(-args.num_samples // dist.get_world_size())
+    ground_true, decoder_masks = [], []
+
+    def requests():
+        request_id = 0
+        while request_id < num_rows:
+            batch, _ = next(val_dataloader)
+            for row in range(batch['input_ids'].shape[0]):
+                if request_id == num_rows:
+                    return
+                length = int(batch['attention_mask'][row].sum())
+                ground_true.append(batch['decoder_input_ids'][row])
+                decoder_masks.append(batch['decoder_attention_mask'][row])
+                yield request_id, {
+                    'input_ids': batch['input_ids'][row, :length].to(dist_util.dev()),
+                    'attention_mask': batch['attention_mask'][row, :length].to(dist_util.dev()),
+                }
+                request_id += 1
+
+    row_shape = (args.sequence_len, model.input_transformers.shared.weight.shape[1])
+    samples = [None] * num_rows
+    for request_id, sample in diffusion.p_sample_loop_continuous(
+            model,
+            requests(),
+            args.batch_size,
+            row_shape,
+            clip_denoised=args.clip_denoised,
+            denoised_fn=None,
+            top_p=args.top_p,
+    ):
+        samples[request_id] = sample
+        if request_id % 100 == 0:
+            logger.log(f"finished request {request_id}")
+    cands = th.topk(model.get_logits(th.stack(samples)), k=1, dim=-1).indices.squeeze(-1)
+    ground_true = th.stack(ground_true).to(dist_util.dev())
+    if args.decoder_attention_mask:
+        cands[th.stack(decoder_masks).to(dist_util.dev()) == 0] = 1
+    return cands, ground_true
+
+
+def all_gather_rows(tensor):
+    """
+    all_gather for tensors whose first dimension differs between ranks (token-budget
+    batches): pad every rank to the largest row count, gather, and trim again.
+    """
+    num_rows = th.tensor([tensor.shape[0]], device=tensor.device)
+    gathered_rows = [th.zeros_like(num_rows) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered_rows, num_rows)
+    max_rows = int(max(rows.item() for rows in gathered_rows))
+    padded = tensor.new_zeros((max_rows,) + tuple(tensor.shape[1:]))
+    padded[: tensor.shape[0]] = tensor
+    gathered = [th.zeros_like(padded) for _ in range(dist.get_world_size())]
+    dist.all_gather(gathered, padded)  # gather not supported with NCCL
+    return [sample[: int(rows.item())] for sample, rows in zip(gathered, gathered_rows)]
+
+
 def load_embeddings(checkpoint_path, tokenizer, emb_dim):
     embeddings = th.nn.Embedding(tokenizer.vocab_size, emb_dim)
     embeddings.load_state_dict(th.load(f'{checkpoint_path}/random_emb.torch'))
@@ -183,26 +272,32 @@ def write_outputs(args: dict, sentences: List[str], gt_sentences: List[str], raw
         comments = f'predict_by_mixsample_{args.generate_by_mix_prob}_{args.generate_by_mix_part}_{args.seed}'
     else:
         comments = f'normal_{args.seed}'
+    if args.use_ddim:
+        comments = f'ddim_{args.ddim_steps}_{args.ddim_eta}_{comments}'
     num_samples = len(sentences)
-    output_file_basepath = os.path.join(
-        model_dir,
-        f"{model_base_name}.samples_{num_samples}.steps-{args.diffusion_steps}.clamp-{args.clamp}-{comments}",
-    ) + ".txt"
+    if args.output_path:
+        output_file_basepath = args.output_path
+        raw_output_file_basepath = os.path.splitext(args.output_path)[0] + ".raw-output-ids.txt"
+    else:
+        output_file_basepath = os.path.join(
+            model_dir,
+            f"{model_base_name}.samples_{num_samples}.steps-{args.diffusion_steps}.clamp-{args.clamp}-{comments}",
+        ) + ".txt"
+        raw_output_file_basepath = os.path.join(
+            model_dir,
+            f"{model_base_name}.samples_{num_samples}.steps-{args.diffusion_steps}.clamp-{args.clamp}.raw-output-ids-{comments}",
+        ) + ".txt"
     with open(output_file_basepath, "w") as text_fout:
         for generated_sentence, ground_true_sentence in zip(sentences, gt_sentences):
             text_fout.write(json.dumps([generated_sentence, ground_true_sentence]) + "\n")
 
         print(f"written the decoded output to {output_file_basepath}")
 
-    output_file_basepath = os.path.join(
-        model_dir,
-        f"{model_base_name}.samples_{num_samples}.steps-{args.diffusion_steps}.clamp-{args.clamp}.raw-output-ids-{comments}",
-    ) + ".txt"
-    with open(output_file_basepath, "w") as text_fout:
+    with open(raw_output_file_basepath, "w") as text_fout:
         for generated_sentence, ground_true_sentence in zip(raw_sentences, raw_gt_sentences):
             text_fout.write(json.dumps([generated_sentence.tolist(), ground_true_sentence.tolist()]) + "\n")
 
-        print(f"written the decoded output to {output_file_basepath}")
+        print(f"written the decoded output to {raw_output_file_basepath}")
 
 
 if __name__ == "__main__":
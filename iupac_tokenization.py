@@ -10,6 +10,7 @@ from transformers import (
 )
 import os
 import re
+from collections import namedtuple
 import pandas as pd
 import numpy as np
 import torch
@@ -35,6 +36,10 @@ class T5Collator:
                 batch[k] = torch.FloatTensor([r[k] for r in records]) #torch.Tensor
         return batch
 
+# what T5IUPACTokenizer.encode_batch returns per text, mirrors tokenizers.Encoding.ids
+IUPACEncoding = namedtuple("IUPACEncoding", ["ids"])
+
+
 class T5IUPACTokenizer(T5Tokenizer):
     def prepare_for_tokenization(self, text, is_split_into_words=False,
                                  **kwargs):
@@ -61,6 +66,35 @@ class T5IUPACTokenizer(T5Tokenizer):
         # sentencepiece adds a non-printing token at the start. Remove it
         return ["<unk>"]+pieces[1:]
 
+    def encode_batch(self, texts, num_threads=1):
+        """
+        Same ids as `self(texts)["input_ids"]`, but the whole batch goes through the
+        compiled sentencepiece encoder in `num_threads` threads (-1: all cores) instead
+        of being tokenized string by string in Python. One thread by default, as this
+        also runs inside data loader and process pool workers.
+        """
+        texts = [self.prepare_for_tokenization(text)[0] for text in texts]
+        encoded = self.sp_model.encode(texts, out_type=int, num_threads=num_threads)
+        # same as _tokenize: the leading piece becomes <unk>, then </s> is appended;
+        # an empty text never reaches _tokenize and only gets the </s>
+        return [IUPACEncoding(([self.unk_token_id] + ids[1:] if text else []) + [self.eos_token_id])
+                for text, ids in zip(texts, encoded)]
+
+    def decode_batch(self, sequences, num_threads=-1):
+        """
+        Same strings as `decode(ids, skip_special_tokens=True)` for every row of
+        `sequences`, decoded by sentencepiece in `num_threads` threads.
+        """
+        special_ids = set(self.all_special_ids)
+        num_pieces = self.sp_model.get_piece_size()
+        sequences = [[i for i in ids if i < num_pieces and i not in special_ids] for ids in sequences]
+        texts = self.sp_model.decode(sequences, num_threads=num_threads)
+        if self.clean_up_tokenization_spaces:
+            texts = [self.clean_up_tokenization(text) for text in texts]
+        # in the order of _decode: clean up first, then "_" becomes " "; special tokens
+        # are skipped, so the extra_id_ guard is not needed here
+        return [text.replace("_", " ") for text in texts]
+
 
 def get_iupac_tokenizer(is_train=1,full_path = './data'):
 
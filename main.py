@@ -48,6 +48,9 @@ def main():
         max_seq_len_src=args.sequence_len_src,
     )
 
+    if args.device_prefetch:
+        train_dataloader = dataloader_utils.DevicePrefetcher(train_dataloader, dist_util.dev())
+
     val_dataloader = dataloader_utils.get_dataloader(
         iupac_tokenizer=iupac_tokenizer,
         smiles_tokenizer=smiles_tokenizer,
@@ -85,6 +88,8 @@ def main():
         data=train_dataloader,
         batch_size=args.batch_size,
         microbatch=args.microbatch,
+        max_tokens=args.max_tokens,
+        microbatch_tokens=args.microbatch_tokens,
         lr=args.lr,
         ema_rate=args.ema_rate,
         log_interval=args.log_interval,
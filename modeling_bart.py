@@ -102,20 +102,6 @@ def _make_causal_mask(input_ids_shape: torch.Size, dtype: torch.dtype, past_key_
         mask = torch.cat([torch.zeros(tgt_len, past_key_values_length, dtype=dtype), mask], dim=-1)
     return mask[None, None, :, :].expand(bsz, 1, tgt_len, tgt_len + past_key_values_length)
 
-def _make_no_causal_mask(input_ids_shape: torch.Size, dtype: torch.dtype, past_key_values_length: int = 0):
-    """
-    Make causal mask used for bi-directional self-attention.
-    """
-    bsz, tgt_len = input_ids_shape
-    mask = torch.full((tgt_len, tgt_len), 0.)
-    mask_cond = torch.arange(mask.size(-1))
-    mask.masked_fill_(mask_cond < (mask_cond + 1).view(mask.size(-1), 1), 0)
-    mask = mask.to(dtype)
-
-    if past_key_values_length > 0:
-        mask = torch.cat([torch.zeros(tgt_len, past_key_values_length, dtype=dtype), mask], dim=-1)
-    return mask[None, None, :, :].expand(bsz, 1, tgt_len, tgt_len + past_key_values_length)
-
 
 def _expand_mask(mask: torch.Tensor, dtype: torch.dtype, tgt_len: Optional[int] = None):
     """
@@ -154,6 +140,9 @@ class BartLearnedPositionalEmbedding(nn.Embedding):
 class BartAttention(nn.Module):
     """Multi-headed attention from 'Attention Is All You Need' paper"""
 
+    # use torch's fused scaled_dot_product_attention (torch>=2.0) when no attention weights or head mask are needed
+    use_sdpa = hasattr(nn.functional, "scaled_dot_product_attention")
+
     def __init__(
         self,
         embed_dim: int,
@@ -201,8 +190,8 @@ class BartAttention(nn.Module):
 
         bsz, tgt_len, _ = hidden_states.size()
 
-        # get query proj
-        query_states = self.q_proj(hidden_states) * self.scaling
+        # get query proj, scaled below (scaled_dot_product_attention applies the same 1/sqrt(head_dim) itself)
+        query_states = self.q_proj(hidden_states)
         # get key, value proj
         if is_cross_attention and past_key_value is not None:
             # reuse k,v, cross_attentions
@@ -233,8 +222,11 @@ class BartAttention(nn.Module):
             # if encoder bi-directional self-attention `past_key_value` is always `None`
             past_key_value = (key_states, value_states)
 
+        if self.use_sdpa and not output_attentions and layer_head_mask is None:
+            return self._sdpa_forward(query_states, key_states, value_states, attention_mask), None, past_key_value
+
         proj_shape = (bsz * self.num_heads, -1, self.head_dim)
-        query_states = self._shape(query_states, tgt_len, bsz).view(*proj_shape)
+        query_states = self._shape(query_states * self.scaling, tgt_len, bsz).view(*proj_shape)
         key_states = key_states.view(*proj_shape)
         value_states = value_states.view(*proj_shape)
 
@@ -294,6 +286,29 @@ class BartAttention(nn.Module):
 
         return attn_output, attn_weights_reshaped, past_key_value
 
+    def _sdpa_forward(self, query_states, key_states, value_states, attention_mask):
+        """
+        The attention output of forward() from torch's scaled_dot_product_attention, which does
+        not materialize the (bsz * num_heads, tgt_len, src_len) weights where a fused kernel applies.
+        `query_states` is the unscaled query projection, `key_states` and `value_states` are
+        (bsz, num_heads, src_len, head_dim) and `attention_mask` is the additive (bsz, 1, tgt_len, src_len) mask.
+        """
+        bsz, tgt_len, _ = query_states.size()
+        src_len = key_states.size(2)
+        if attention_mask is not None and attention_mask.size() != (bsz, 1, tgt_len, src_len):
+            raise ValueError(
+                f"Attention mask should be of size {(bsz, 1, tgt_len, src_len)}, but is {attention_mask.size()}"
+            )
+        attn_output = nn.functional.scaled_dot_product_attention(
+            self._shape(query_states, tgt_len, bsz),
+            key_states,
+            value_states,
+            attn_mask=attention_mask,
+            dropout_p=self.dropout if self.training else 0.0,
+        )
+        attn_output = attn_output.transpose(1, 2).reshape(bsz, tgt_len, self.embed_dim)
+        return self.out_proj(attn_output)
+
 
 class BartEncoderLayer(nn.Module):
     def __init__(self, config: BartConfig):
@@ -401,6 +416,7 @@ class BartDecoderLayer(nn.Module):
         past_key_value: Optional[Tuple[torch.Tensor]] = None,
         output_attentions: Optional[bool] = False,
         use_cache: Optional[bool] = True,
+        cross_attn_key_value: Optional[Tuple[torch.Tensor]] = None,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
         """
         Args:
@@ -419,6 +435,9 @@ class BartDecoderLayer(nn.Module):
             output_attentions (`bool`, *optional*):
                 Whether or not to return the attentions tensors of all attention layers. See `attentions` under
                 returned tensors for more detail.
+            cross_attn_key_value (`Tuple(torch.FloatTensor)`): the cross-attention key and value projections of
+                `encoder_hidden_states`, see [`BartDecoder.precompute_cross_attn_key_values`]. Used when
+                `past_key_value` is not given.
         """
         residual = hidden_states
 
@@ -444,7 +463,7 @@ class BartDecoderLayer(nn.Module):
             residual = hidden_states
 
             # cross_attn cached key/values tuple is at positions 3,4 of present_key_value tuple
-            cross_attn_past_key_value = past_key_value[-2:] if past_key_value is not None else None
+            cross_attn_past_key_value = past_key_value[-2:] if past_key_value is not None else cross_attn_key_value
             hidden_states, cross_attn_weights, cross_attn_present_key_value = self.encoder_attn(
                 hidden_states=hidden_states,
                 key_value_states=encoder_hidden_states,
@@ -915,13 +934,9 @@ class BartDecoder(BartPretrainedModel):
         self.embed_tokens = value
 
     def _prepare_decoder_attention_mask(self, attention_mask, input_shape, inputs_embeds, past_key_values_length):
-        # create causal mask
+        # the decoder is bi-directional, so there is no causal mask to combine with the padding mask
         # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
         combined_attention_mask = None
-        if input_shape[-1] > 1:
-            combined_attention_mask = _make_no_causal_mask(
-                input_shape, inputs_embeds.dtype, past_key_values_length=past_key_values_length
-            ).to(self.device)
 
         if attention_mask is not None:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
@@ -932,6 +947,21 @@ class BartDecoder(BartPretrainedModel):
 
         return combined_attention_mask
 
+    def precompute_cross_attn_key_values(self, encoder_hidden_states: torch.FloatTensor):
+        """
+        The key and value projections of `encoder_hidden_states` in the cross-attention of every layer, in the
+        layout `BartAttention` caches them. They only depend on the encoder output, so they can be computed once
+        and passed as `cross_attn_key_values` to every decoder call over the same encoder output.
+        """
+        bsz = encoder_hidden_states.size(0)
+        return tuple(
+            (
+                layer.encoder_attn._shape(layer.encoder_attn.k_proj(encoder_hidden_states), -1, bsz),
+                layer.encoder_attn._shape(layer.encoder_attn.v_proj(encoder_hidden_states), -1, bsz),
+            )
+            for layer in self.layers
+        )
+
     def forward(
         self,
         input_ids: torch.LongTensor = None,
@@ -946,6 +976,7 @@ class BartDecoder(BartPretrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cross_attn_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
     ) -> Union[Tuple, BaseModelOutputWithPastAndCrossAttentions]:
         r"""
         Args:
@@ -1011,6 +1042,11 @@ class BartDecoder(BartPretrainedModel):
                 for more detail.
             return_dict (`bool`, *optional*):
                 Whether or not to return a [`~utils.ModelOutput`] instead of a plain tuple.
+            encoder_attention_mask (`torch.Tensor` of shape `(batch_size, 1, sequence_length, encoder_sequence_length)`, *optional*):
+                May also be passed already expanded by `_expand_mask`, to reuse it across calls.
+            cross_attn_key_values (`tuple(tuple(torch.FloatTensor))`, *optional*):
+                The output of [`precompute_cross_attn_key_values`] for `encoder_hidden_states`, so the
+                cross-attention does not project the encoder output again.
         """
         output_attentions = output_attentions if output_attentions is not None else self.config.output_attentions
         output_hidden_states = (
@@ -1040,8 +1076,8 @@ class BartDecoder(BartPretrainedModel):
             attention_mask, input_shape, inputs_embeds, past_key_values_length
         )
 
-        # expand encoder attention mask
-        if encoder_hidden_states is not None and encoder_attention_mask is not None:
+        # expand encoder attention mask, unless it is already expanded
+        if encoder_hidden_states is not None and encoder_attention_mask is not None and encoder_attention_mask.dim() == 2:
             # [bsz, seq_len] -> [bsz, 1, tgt_seq_len, src_seq_len]
             encoder_attention_mask = _expand_mask(encoder_attention_mask, inputs_embeds.dtype, tgt_len=input_shape[-1])
 
@@ -1116,6 +1152,7 @@ class BartDecoder(BartPretrainedModel):
                     past_key_value=past_key_value,
                     output_attentions=output_attentions,
                     use_cache=use_cache,
+                    cross_attn_key_value=cross_attn_key_values[idx] if cross_attn_key_values is not None else None,
                 )
             hidden_states = layer_outputs[0]
 
@@ -1204,6 +1241,8 @@ class BartModel(BartPretrainedModel):
         output_attentions: Optional[bool] = None,
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
+        cross_attn_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
+        encoder_attention_mask: Optional[torch.Tensor] = None,
     ) -> Union[Tuple, Seq2SeqModelOutput]:
 
         # different to other models, Bart automatically creates decoder_input_ids from
@@ -1250,7 +1289,8 @@ class BartModel(BartPretrainedModel):
             input_ids=decoder_input_ids,
             attention_mask=decoder_attention_mask,
             encoder_hidden_states=encoder_outputs[0],
-            encoder_attention_mask=attention_mask,
+            # an expanded copy of attention_mask, if the caller keeps one
+            encoder_attention_mask=encoder_attention_mask if encoder_attention_mask is not None else attention_mask,
             head_mask=decoder_head_mask,
             cross_attn_head_mask=cross_attn_head_mask,
             past_key_values=past_key_values,
@@ -1259,6 +1299,7 @@ class BartModel(BartPretrainedModel):
             output_attentions=output_attentions,
             output_hidden_states=output_hidden_states,
             return_dict=return_dict,
+            cross_attn_key_values=cross_attn_key_values,
         )
 
         if not return_dict:
@@ -0,0 +1,222 @@
+"""
+Build the IUPAC -> SMILES training splits from a PubChem dump.
+
+The csv is streamed in chunks. Every chunk is filtered with the tokenizer validity
+checks and tokenized in a worker process, and the result is checkpointed under
+`<out_dir>/chunks/`, so a crashed run resumes from the first unfinished chunk. The
+chunks are only reused while the csv, chunk size, columns, tokenizers and filters are
+the ones recorded in `<out_dir>/chunks/params.json`; otherwise the run starts over.
+Finished chunks are concatenated into `<out_dir>/train.{iupac,smiles}` and
+`<out_dir>/valid.{iupac,smiles}` (the `--train_txt_path` / `--val_txt_path` layout
+with `--src iupac --tgt smiles`), plus the memory-mapped corpus read by get_dataloader.
+
+    python prepare_data.py --csv_path ./data/pubchem_MolWt200-1000_iupac.csv \
+        --out_dir ./data/wjm14 --num_train 30000000 --num_workers 32
+"""
+import argparse
+import collections
+import hashlib
+import inspect
+import json
+import multiprocessing as mp
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from args_utils import add_dict_to_argparser
+from dataloader_utils import MMapCorpusWriter, _encode, _text_file_stat, tokenizer_fingerprint
+
+_iupac_tokenizer = None
+_smiles_tokenizer = None
+
+
+def create_argparser():
+    defaults = dict(
+        csv_path="./data/pubchem_MolWt200-1000_iupac.csv",
+        out_dir="./data/wjm14",
+        iupac_column="PUBCHEM_IUPAC_NAME",
+        smiles_column="canon_smiles",
+        sep="|",
+        num_train=30000000,
+        chunk_size=200000,
+        num_workers=max(os.cpu_count() - 1, 1),
+        binarize=True,
+    )
+    parser = argparse.ArgumentParser()
+    add_dict_to_argparser(parser, defaults)
+    return parser
+
+
+def seq_valid_iupac(input_ids):
+    # the leading <unk> put there by T5IUPACTokenizer._tokenize has to be the only one
+    return input_ids.count(2) == 1
+
+
+def seq_valid_smiles(input_ids):
+    return input_ids.count(1) == 1
+
+
+def _init_worker(iupac_tokenizer, smiles_tokenizer):
+    global _iupac_tokenizer, _smiles_tokenizer
+    _iupac_tokenizer, _smiles_tokenizer = iupac_tokenizer, smiles_tokenizer
+
+
+def _chunk_path(out_dir, chunk_idx):
+    return os.path.join(out_dir, "chunks", f"chunk_{chunk_idx:06d}")
+
+
+def _chunk_params(args, iupac_tokenizer, smiles_tokenizer):
+    """Everything the content of a chunk depends on."""
+    filters = inspect.getsource(seq_valid_iupac) + inspect.getsource(seq_valid_smiles)
+    return {
+        "csv_path": os.path.abspath(args.csv_path),
+        "csv": _text_file_stat(args.csv_path),
+        "sep": args.sep,
+        "iupac_column": args.iupac_column,
+        "smiles_column": args.smiles_column,
+        "chunk_size": args.chunk_size,
+        "iupac_tokenizer": tokenizer_fingerprint(iupac_tokenizer),
+        "smiles_tokenizer": tokenizer_fingerprint(smiles_tokenizer),
+        "filters": hashlib.sha1(filters.encode()).hexdigest(),
+    }
+
+
+def _prepare_chunk_dir(args, iupac_tokenizer, smiles_tokenizer):
+    """
+    Keep the checkpointed chunks only if they were made with the current parameters;
+    chunks of another chunk size or tokenizer would duplicate, drop or mistokenize rows.
+    """
+    chunk_dir = os.path.join(args.out_dir, "chunks")
+    params_path = os.path.join(chunk_dir, "params.json")
+    params = _chunk_params(args, iupac_tokenizer, smiles_tokenizer)
+    if os.path.exists(params_path):
+        with open(params_path) as f:
+            if json.load(f) == params:
+                return
+    if os.path.isdir(chunk_dir) and os.listdir(chunk_dir):
+        print(f"{chunk_dir} was checkpointed with other parameters, starting over")
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir, exist_ok=True)
+    with open(params_path + ".tmp", "w") as f:
+        json.dump(params, f, indent=2)
+    os.replace(params_path + ".tmp", params_path)
+
+
+def _pack(input_ids):
+    lengths = np.array([len(ids) for ids in input_ids], dtype=np.int64)
+    tokens = np.fromiter((tok for ids in input_ids for tok in ids), dtype=np.int32, count=int(lengths.sum()))
+    return tokens, lengths
+
+
+def _process_chunk(chunk_idx, out_dir, iupac_names, smiles):
+    """
+    Filter and tokenize one chunk and checkpoint it. The `.done` marker is written
+    last, so a chunk without it is simply redone on resume.
+    """
+    src_ids = _encode(_iupac_tokenizer, iupac_names)
+    tgt_ids = _encode(_smiles_tokenizer, smiles)
+    keep = [seq_valid_iupac(s) and seq_valid_smiles(t) for s, t in zip(src_ids, tgt_ids)]
+
+    src_ids = [ids for ids, k in zip(src_ids, keep) if k]
+    tgt_ids = [ids for ids, k in zip(tgt_ids, keep) if k]
+    path = _chunk_path(out_dir, chunk_idx)
+    with open(path + ".iupac", "w") as f:
+        f.writelines(name + "\n" for name, k in zip(iupac_names, keep) if k)
+    with open(path + ".smiles", "w") as f:
+        f.writelines(smi + "\n" for smi, k in zip(smiles, keep) if k)
+    src_tokens, src_lengths = _pack(src_ids)
+    tgt_tokens, tgt_lengths = _pack(tgt_ids)
+    np.savez(path + ".npz", src_tokens=src_tokens, src_lengths=src_lengths,
+             tgt_tokens=tgt_tokens, tgt_lengths=tgt_lengths)
+
+    stats = {"num_rows": len(keep), "num_valid": len(src_ids)}
+    with open(path + ".done.tmp", "w") as f:
+        json.dump(stats, f)
+    os.replace(path + ".done.tmp", path + ".done")
+    return chunk_idx, stats
+
+
+def process_csv(args, iupac_tokenizer, smiles_tokenizer):
+    """
+    Run every chunk of the csv through the worker pool, skipping chunks that are
+    already checkpointed. At most `2 * num_workers` chunks are in flight, so memory
+    stays bounded by the chunk size rather than the dump size.
+    """
+    _prepare_chunk_dir(args, iupac_tokenizer, smiles_tokenizer)
+    reader = pd.read_csv(args.csv_path, sep=args.sep, header=0, chunksize=args.chunk_size,
+                         usecols=[args.iupac_column, args.smiles_column], dtype=str)
+    num_chunks = 0
+    with mp.Pool(args.num_workers, initializer=_init_worker, initargs=(iupac_tokenizer, smiles_tokenizer)) as pool:
+        pending = collections.deque()
+        for chunk_idx, chunk in enumerate(reader):
+            num_chunks += 1
+            if os.path.exists(_chunk_path(args.out_dir, chunk_idx) + ".done"):
+                continue
+            chunk = chunk.dropna()
+            pending.append(pool.apply_async(_process_chunk, (
+                chunk_idx, args.out_dir,
+                chunk[args.iupac_column].tolist(), chunk[args.smiles_column].tolist(),
+            )))
+            while len(pending) >= 2 * args.num_workers:
+                _log_chunk(*pending.popleft().get())
+        while pending:
+            _log_chunk(*pending.popleft().get())
+    return num_chunks
+
+
+def _log_chunk(chunk_idx, stats):
+    print(f"chunk {chunk_idx}: kept {stats['num_valid']} of {stats['num_rows']} pairs")
+
+
+def write_splits(args, num_chunks, iupac_tokenizer, smiles_tokenizer):
+    """
+    Concatenate the checkpointed chunks in csv order: the first `num_train` valid
+    pairs go to the train split and the rest to the valid split.
+    """
+    splits = {name: {lang: open(os.path.join(args.out_dir, f"{name}.{lang}"), "w") for lang in ("iupac", "smiles")}
+              for name in ("train", "valid")}
+    tokenizers = {"iupac": iupac_tokenizer, "smiles": smiles_tokenizer}
+    writers = {name: {lang: MMapCorpusWriter(os.path.join(args.out_dir, f"{name}.{lang}"), tokenizers[lang])
+                      for lang in ("iupac", "smiles")}
+               for name in ("train", "valid")} if args.binarize else None
+    num_written = 0
+    for chunk_idx in range(num_chunks):
+        path = _chunk_path(args.out_dir, chunk_idx)
+        with open(path + ".done") as f:
+            num_valid = json.load(f)["num_valid"]
+        num_train = min(max(args.num_train - num_written, 0), num_valid)
+        for lang in ("iupac", "smiles"):
+            with open(f"{path}.{lang}") as f:
+                lines = f.readlines()
+            splits["train"][lang].writelines(lines[:num_train])
+            splits["valid"][lang].writelines(lines[num_train:])
+        if writers is not None:
+            packed = np.load(path + ".npz")
+            for lang, side in (("iupac", "src"), ("smiles", "tgt")):
+                tokens, lengths = packed[f"{side}_tokens"], packed[f"{side}_lengths"]
+                split_at = int(lengths[:num_train].sum())
+                writers["train"][lang].add_packed(tokens[:split_at], lengths[:num_train])
+                writers["valid"][lang].add_packed(tokens[split_at:], lengths[num_train:])
+        num_written += num_valid
+
+    for name in splits:
+        for lang in splits[name]:
+            splits[name][lang].close()
+            if writers is not None:
+                writers[name][lang].close()
+    print(f"wrote {min(num_written, args.num_train)} train and {max(num_written - args.num_train, 0)} valid pairs to {args.out_dir}")
+
+
+def main():
+    args = create_argparser().parse_args()
+    from tokenizer_utils import create_iupac_smiles_tokenizer
+
+    iupac_tokenizer, smiles_tokenizer = create_iupac_smiles_tokenizer(return_pretokenized=True, path=None)
+    num_chunks = process_csv(args, iupac_tokenizer, smiles_tokenizer)
+    write_splits(args, num_chunks, iupac_tokenizer, smiles_tokenizer)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,11 @@ from tokenizers import AddedToken, Tokenizer
 from tokenizers import decoders, models, normalizers, processors, trainers
 from tokenizers.implementations import BaseTokenizer
 from transformers import PreTrainedTokenizerFast
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
 import torch
 import os.path as pt
 
@@ -200,9 +205,40 @@ class SMILESAlphabet(Collection):
                 alphabet.add(token)
         return alphabet
 
+def _file_sha256(filename: str) -> str:
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def _tokenizer_cache_key(filename: str, train_params: Dict[str, Any], cached: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Identify a BPE training run by the training file content and the training parameters.
+
+    The file is only hashed again when its size or mtime differ from the cached entry.
+    """
+    stat = os.stat(filename)
+    key = {"train_file": pt.abspath(filename), "train_file_size": stat.st_size,
+           "train_file_mtime_ns": stat.st_mtime_ns, **train_params}
+    if cached is not None and all(cached.get(k) == key[k] for k in ("train_file_size", "train_file_mtime_ns")):
+        key["train_file_sha256"] = cached.get("train_file_sha256")
+    else:
+        key["train_file_sha256"] = _file_sha256(filename)
+    return key
+
+
+def _cache_matches(key: Dict[str, Any], cached: Optional[Dict[str, Any]]) -> bool:
+    # the file path and mtime may change without the content changing
+    ignored = ("train_file", "train_file_mtime_ns")
+    return cached is not None and {k: v for k, v in key.items() if k not in ignored} == \
+        {k: v for k, v in cached.items() if k not in ignored}
+
+
 def get_smiles_tokenizer(is_train=1,checkpoint = "./data/smile_tocken"):
 
     tokenizer_filename = f"{checkpoint}/tokenizer.json"
+    meta_filename = f"{checkpoint}/tokenizer.meta.json"
     #filename = "./data/smile_tocken/train_data_new.csv"
 
     filename = "./data/smile_tocken/train_data.csv"
@@ -215,23 +251,50 @@ def get_smiles_tokenizer(is_train=1,checkpoint = "./data/smile_tocken"):
                "vocab_size": 200, "min_frequency": 2, "top_p": 0.96,
                "n_layer": 8, "n_head": 8, "n_embd": 256}
 
-    alphabet = list(SMILESAlphabet().get_alphabet())
-    tokenizer = SMILESBPETokenizer(dropout=None)
-    tokenizer.train(filename,
-                vocab_size=hyperparams["vocab_size"] + len(alphabet),
-                min_frequency=hyperparams["min_frequency"],
-                initial_alphabet=alphabet)
-    tokenizer.save_model(checkpoint)
-    tokenizer.save(tokenizer_filename)
-
-    tokenizer = SMILESBPETokenizer.get_hf_tokenizer(tokenizer_filename, model_max_length=hyperparams["max_length"])
-
-    if is_train:
-        torch.save(tokenizer, pt.join(checkpoint,"real_smiles_tokenizer.pt"))
-        print("smiles_tokenizer saving...",len(tokenizer))
-    else:
-        tokenizer = torch.load(pt.join(checkpoint,"real_smiles_tokenizer.pt"), map_location="cpu")
-        print("smiles_tokenizer loading...",len(tokenizer))
+    alphabet = sorted(SMILESAlphabet().get_alphabet())
+    train_params = {"vocab_size": hyperparams["vocab_size"] + len(alphabet),
+                    "min_frequency": hyperparams["min_frequency"],
+                    "initial_alphabet": alphabet}
+
+    # every rank calls this at startup: the first one to take the lock trains and saves,
+    # the others wait for it and then find a matching cache
+    with open(f"{checkpoint}/tokenizer.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cached = None
+        if pt.exists(meta_filename) and pt.exists(tokenizer_filename):
+            with open(meta_filename) as f:
+                cached = json.load(f)
+        key = _tokenizer_cache_key(filename, train_params, cached)
+
+        if _cache_matches(key, cached):
+            print(f"smiles_tokenizer: reusing {tokenizer_filename}")
+        else:
+            print(f"smiles_tokenizer: training on {filename}")
+            tokenizer = SMILESBPETokenizer(dropout=None)
+            tokenizer.train(filename, **train_params)
+            # the meta file vouches for the files next to it: drop it before they change and
+            # write it last, so an interrupted run leaves no meta file with partial files
+            try:
+                os.remove(meta_filename)
+            except FileNotFoundError:
+                pass
+            with tempfile.TemporaryDirectory(dir=checkpoint) as tmp_dir:
+                for saved in tokenizer.save_model(tmp_dir):
+                    os.replace(saved, pt.join(checkpoint, pt.basename(saved)))
+                tokenizer.save(pt.join(tmp_dir, "tokenizer.json"))
+                os.replace(pt.join(tmp_dir, "tokenizer.json"), tokenizer_filename)
+            with open(meta_filename + f".{os.getpid()}.tmp", "w") as f:
+                json.dump(key, f, indent=2)
+            os.replace(meta_filename + f".{os.getpid()}.tmp", meta_filename)
+
+        tokenizer = SMILESBPETokenizer.get_hf_tokenizer(tokenizer_filename, model_max_length=hyperparams["max_length"])
+
+        if is_train:
+            torch.save(tokenizer, pt.join(checkpoint,"real_smiles_tokenizer.pt"))
+            print("smiles_tokenizer saving...",len(tokenizer))
+        else:
+            tokenizer = torch.load(pt.join(checkpoint,"real_smiles_tokenizer.pt"), map_location="cpu")
+            print("smiles_tokenizer loading...",len(tokenizer))
 
     return tokenizer
 
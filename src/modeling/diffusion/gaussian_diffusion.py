@@ -13,7 +13,10 @@ Aman's notes:
 """
 import torch.distributed as dist
 
+import atexit
+import concurrent.futures
 import enum
+import functools
 import math
 
 import numpy as np
@@ -213,6 +216,9 @@ class GaussianDiffusion:
         print('schedule update stride', self._loss_history_update_stride)
         self._loss_history = np.ones((self.num_timesteps//self._loss_interp_granu, self.token_max_length)) * np.linspace(0, 0.5, self.num_timesteps//self._loss_interp_granu)[:,None]
         self._loss_history_count = np.ones((self.num_timesteps//self._loss_interp_granu, self.token_max_length))
+        self._loss_history_delta = None
+        self._refit_executor = None
+        self._pending_refit = None
 
         alphas = 1.0 - betas
 
@@ -247,16 +253,16 @@ class GaussianDiffusion:
 
         self.training_mode = training_mode
         print("training mode is ", training_mode)
+        self._schedule_cache = {}
+        self._step_fn = None
     
     def update_time_discretized_parameters(self, alphas_cumprod):
+        self._schedule_cache = {}
 
         self.alphas_cumprod[:, 1:] = alphas_cumprod[:, 1:] # only change schedule of tokens other than bos token
         alphas = np.zeros_like(alphas_cumprod)
-        for i in range(len(alphas_cumprod)):
-            if i == 0:
-                alphas[i] = self.alphas_cumprod[i]
-            else:
-                alphas[i] = self.alphas_cumprod[i] / self.alphas_cumprod[i-1]
+        alphas[0] = self.alphas_cumprod[0]
+        alphas[1:] = self.alphas_cumprod[1:] / self.alphas_cumprod[:-1]
         betas = 1.0 - alphas
 
         if self.token_max_length is not None:
@@ -289,70 +295,139 @@ class GaussianDiffusion:
             (1.0 - self.alphas_cumprod_prev) * np.sqrt(alphas) / (1.0 - self.alphas_cumprod)
         )
     
+    def _schedule_array(self, name):
+        # tables that are only ever used through _extract and have no attribute of their own
+        derived = {
+            "one_minus_alphas_cumprod": lambda: 1.0 - self.alphas_cumprod,
+            "recip_posterior_mean_coef1": lambda: 1.0 / self.posterior_mean_coef1,
+            "posterior_mean_coef2_over_coef1": lambda: self.posterior_mean_coef2 / self.posterior_mean_coef1,
+            "fixed_large_variance": lambda: np.append(self.posterior_variance[1], self.betas[1:]),
+            "fixed_large_log_variance": lambda: np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+            "sample_std": self._sample_std,
+        }
+        return derived[name]() if name in derived else getattr(self, name)
+
+    def _sample_std(self):
+        # exp(0.5 * log_variance) of p_sample, zero at t == 0 where no noise is added
+        log_variance = {
+            ModelVarType.FIXED_LARGE: "fixed_large_log_variance",
+            ModelVarType.FIXED_SMALL: "posterior_log_variance_clipped",
+        }[self.model_var_type]
+        std = np.exp(0.5 * np.asarray(self._schedule_array(log_variance), dtype=np.float64))
+        std[0] = 0.0
+        return std
+
+    def _schedule(self, name, device):
+        """
+        float32 copy of the schedule table `name` on `device`. The copies are made once
+        and dropped by update_time_discretized_parameters, so sampling steps only gather.
+        """
+        key = (name, device)
+        if key not in self._schedule_cache:
+            table = th.from_numpy(np.asarray(self._schedule_array(name)))
+            self._schedule_cache[key] = table.to(device=device, dtype=th.float32)
+        return self._schedule_cache[key]
+
+    def _extract(self, name, timesteps, broadcast_shape):
+        return _extract_into_tensor(self._schedule(name, timesteps.device), timesteps, broadcast_shape)
+
     def _load_time_schedule(self, path):
 
         alphas_cumprod = np.load(path)
         self.update_time_discretized_parameters(alphas_cumprod)
     
-    def _loss_history_update(self, ts, losses, loss_masks, training_step): #v5
+    def _loss_history_update(self, ts, losses, loss_masks): #v5
         """
         ts is a vector of shape B
         losses is a tensor of shape BxS
 
         self._loss_history is TxS
         """
-        all_losses = []
-        losses_gather_buffer = [th.zeros_like(losses) for _ in range(dist.get_world_size())]
-        dist.all_gather(losses_gather_buffer, losses.detach())
-        all_losses.extend([sample.cpu().numpy() for sample in losses_gather_buffer])
-        all_losses = np.concatenate(all_losses, axis=0) #BXS
-
-        all_loss_masks = []
-        loss_masks_gather_buffer = [th.zeros_like(loss_masks) for _ in range(dist.get_world_size())]
-        dist.all_gather(loss_masks_gather_buffer, loss_masks.detach())
-        all_loss_masks.extend([sample.cpu().numpy() for sample in loss_masks_gather_buffer])
-        all_loss_masks = np.concatenate(all_loss_masks, axis=0) #BxS
-
-        all_ts = []
-        ts_gather_buffer = [th.zeros_like(ts) for _ in range(dist.get_world_size())]
-        dist.all_gather(ts_gather_buffer, ts.detach())
-        all_ts.extend([sample.cpu().numpy() for sample in ts_gather_buffer])
-        all_ts = np.concatenate(all_ts, axis=0) #B.  0-1999
-
-        all_ts = all_ts // self._loss_interp_granu # 0-99 self._loss_interp_granu=20
-        
-        for t, loss, loss_m in zip(all_ts, all_losses, all_loss_masks):
-            self._loss_history[t] += loss
-            self._loss_history_count[t] += loss_m.astype(float)  #loss_m 64 shape.  [1,1,1,0,0,0,0,0,0,0]
-
+        # the sums of this rank's losses and loss masks per timestep bucket since the last
+        # refit, 2 x T/granu x S on the loss device; the ranks are summed by sync_loss_history
+        if self._loss_history_delta is None or self._loss_history_delta.device != losses.device:
+            self._loss_history_delta = th.zeros((2,) + self._loss_history.shape, dtype=th.float64, device=losses.device)
+        buckets = ts.detach() // self._loss_interp_granu # 0-99 self._loss_interp_granu=20
+        self._loss_history_delta[0].index_add_(0, buckets, losses.detach().double())
+        self._loss_history_delta[1].index_add_(0, buckets, loss_masks.detach().double())  #loss_m 64 shape.  [1,1,1,0,0,0,0,0,0,0]
+
+    def sync_loss_history(self, training_step):
+        """
+        At a refit step, sum the loss history of all ranks and start refitting the schedule
+        from it. Every rank calls this once per optimizer step, after all of its microbatches,
+        so the reduce runs the same number of times on every rank whatever the number of
+        microbatches it had (--max_tokens).
+        """
         if training_step >= (self._loss_history_update_stride*3) and training_step % self._loss_history_update_stride == 0:
-            interp_alpha_cumprod = []
-            loss_dist = self._loss_history / self._loss_history_count # TxS
-            for i in range(loss_dist.shape[0]):
-                if i > 0:
-                    loss_dist[i, :] = np.max([loss_dist[i, :], loss_dist[i-1, :]+1e-5], axis=0)
-            loss_dist = np.vstack([loss_dist[:1, :]-(loss_dist[1:2, :]-loss_dist[:1, :])/2, loss_dist, loss_dist[-1:, :]+(loss_dist[-1:, :]-loss_dist[-2:-1, :])/2])
-
-            for s in range(loss_dist.shape[1]):
-                loss_val = np.linspace(np.min(loss_dist[:, s])-1e-5, np.max(loss_dist[:, s])+1e-5, self.num_timesteps)
-                alpha_cumprod_dist = np.mean(self.alphas_cumprod[:, s].reshape(-1, self._loss_interp_granu), axis=1)
-                alpha_cumprod_dist = np.append(np.max(self.alphas_cumprod), alpha_cumprod_dist)
-                alpha_cumprod_dist = np.append(alpha_cumprod_dist, np.min(self.alphas_cumprod))
-                interp_alpha_cumprod.append(np.interp(loss_val, loss_dist[:, s], alpha_cumprod_dist))
-
-            
-            interp_alpha_cumprod = np.stack(interp_alpha_cumprod).transpose(1,0)
-            self.update_time_discretized_parameters(interp_alpha_cumprod)
-            
-            if dist.get_rank() == 0:
-                print('*'*10, f'updated alpha_cumprod to /alpha_cumprod_step_{training_step}.npy', '*'*10)
-                np.save(os.path.join(self.save_dir, f'alpha_cumprod_step_{training_step}.npy'), self.alphas_cumprod)
-                np.save(os.path.join(self.save_dir, f'loss_step_{training_step}.npy'), self._loss_history)
-                np.save(os.path.join(self.save_dir, f'loss_count_{training_step}.npy'), self._loss_history_count)
+            dist.all_reduce(self._loss_history_delta)
+            loss_history_delta = self._loss_history_delta.cpu().numpy()
+            self._loss_history += loss_history_delta[0]
+            self._loss_history_count += loss_history_delta[1]
+            self._loss_history_delta.zero_()  # after the numpy view is used, it shares memory on cpu
+
+            # the refit runs on a background thread from a snapshot of the history and is
+            # applied by apply_schedule_refit at the start of the next training step
+            if self._refit_executor is None:
+                self._refit_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                # let the schedule saves still queued on it finish before the process exits
+                atexit.register(self._refit_executor.shutdown)
+            self._pending_refit = (training_step, self._refit_executor.submit(
+                self._refit_schedule, training_step, self._loss_history, self._loss_history_count,
+                self.alphas_cumprod.copy(),
+            ))
 
             self._loss_history = np.ones((self.num_timesteps//self._loss_interp_granu, self.token_max_length)) * np.linspace(0, 0.5, self.num_timesteps//self._loss_interp_granu)[:,None]
             self._loss_history_count = np.ones((self.num_timesteps//self._loss_interp_granu, self.token_max_length))
-                
+
+    def _refit_schedule(self, training_step, loss_history, loss_history_count, alphas_cumprod):
+        """
+        Fit a new T x S alphas_cumprod to the mean loss per timestep bucket: the loss
+        curve of every token is made strictly increasing and the alphas are
+        interpolated so that the loss grows linearly over the timesteps. Only reads
+        its arguments, so it can run off the training thread; rank 0 also queues a save
+        of the new schedule and the history it came from, which nobody waits on.
+        """
+        loss_dist = loss_history / loss_history_count # TxS
+        # loss_dist[i] = max(loss_dist[i], loss_dist[i-1] + 1e-5) for every i, as one cummax
+        step = 1e-5 * np.arange(loss_dist.shape[0])[:, None]
+        loss_dist = np.maximum.accumulate(loss_dist - step, axis=0) + step
+        loss_dist = np.vstack([loss_dist[:1, :]-(loss_dist[1:2, :]-loss_dist[:1, :])/2, loss_dist, loss_dist[-1:, :]+(loss_dist[-1:, :]-loss_dist[-2:-1, :])/2])
+
+        loss_val = np.linspace(loss_dist.min(axis=0)-1e-5, loss_dist.max(axis=0)+1e-5, self.num_timesteps) # TxS
+        alpha_cumprod_dist = alphas_cumprod.reshape(-1, self._loss_interp_granu, alphas_cumprod.shape[1]).mean(axis=1)
+        alpha_cumprod_dist = np.vstack([
+            np.full((1, alphas_cumprod.shape[1]), np.max(alphas_cumprod)),
+            alpha_cumprod_dist,
+            np.full((1, alphas_cumprod.shape[1]), np.min(alphas_cumprod)),
+        ])
+        interp_alpha_cumprod = _interp_columns(loss_val, loss_dist, alpha_cumprod_dist)
+
+        if dist.get_rank() == 0:
+            saved_alphas_cumprod = alphas_cumprod.copy()
+            saved_alphas_cumprod[:, 1:] = interp_alpha_cumprod[:, 1:] # as update_time_discretized_parameters keeps it
+            # runs after this job returns, so apply_schedule_refit never waits for the disk
+            self._refit_executor.submit(
+                self._save_refit, training_step, saved_alphas_cumprod, loss_history, loss_history_count,
+            )
+        return interp_alpha_cumprod
+
+    def _save_refit(self, training_step, alphas_cumprod, loss_history, loss_history_count):
+        print('*'*10, f'updated alpha_cumprod to /alpha_cumprod_step_{training_step}.npy', '*'*10)
+        np.save(os.path.join(self.save_dir, f'alpha_cumprod_step_{training_step}.npy'), alphas_cumprod)
+        np.save(os.path.join(self.save_dir, f'loss_step_{training_step}.npy'), loss_history)
+        np.save(os.path.join(self.save_dir, f'loss_count_{training_step}.npy'), loss_history_count)
+
+    def apply_schedule_refit(self, training_step):
+        """
+        Switch to the schedule refit at an earlier step, waiting for it if it is still
+        running, so every rank changes schedule at the same step.
+        """
+        if self._pending_refit is None or self._pending_refit[0] >= training_step:
+            return
+        _, refit = self._pending_refit
+        self._pending_refit = None
+        self.update_time_discretized_parameters(refit.result())
+
     def training_losses(self, model, training_step, t, model_kwargs=None, noise=None):
         """
         Compute training losses for a single timestep.
@@ -368,6 +443,7 @@ class GaussianDiffusion:
         """
         assert "input_ids" in model_kwargs
         assert "decoder_input_ids" in model_kwargs
+        self.apply_schedule_refit(training_step)
         input_ids = model_kwargs.pop("decoder_input_ids").to(t.device)
         if 'loss_mask' in model_kwargs:
             loss_mask = model_kwargs.pop('loss_mask').to(t.device)
@@ -375,8 +451,8 @@ class GaussianDiffusion:
             loss_mask = None
         x_start_mean = model.model.module.get_embeds(input_ids)
 
-        std = _extract_into_tensor(
-            self.sqrt_one_minus_alphas_cumprod,
+        std = self._extract(
+            "sqrt_one_minus_alphas_cumprod",
             th.tensor([0]).to(x_start_mean.device),
             x_start_mean.shape,
         )
@@ -423,7 +499,7 @@ class GaussianDiffusion:
             _loss_log = mse_loss_log_
             _loss_log[t0_mask] = t0_loss_log_[t0_mask]
             _loss_log[input_ids==self.pad_tok_id] = 0
-            self._loss_history_update(t, _loss_log, input_ids!=self.pad_tok_id, training_step)
+            self._loss_history_update(t, _loss_log, input_ids!=self.pad_tok_id)
 
         out_mean, _, _ = self.q_mean_variance(
             x_start, th.LongTensor([self.num_timesteps - 1]).to(x_start.device)
@@ -461,8 +537,8 @@ class GaussianDiffusion:
             noise = th.randn_like(x_start)
         assert noise.shape == x_start.shape
         return (
-            _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-            + _extract_into_tensor(self.sqrt_one_minus_alphas_cumprod, t, x_start.shape) * noise
+            self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+            + self._extract("sqrt_one_minus_alphas_cumprod", t, x_start.shape) * noise
         )
 
     def q_posterior_mean_variance(self, x_start, x_t, t):
@@ -476,12 +552,12 @@ class GaussianDiffusion:
         """
         assert x_start.shape == x_t.shape
         posterior_mean = (
-            _extract_into_tensor(self.posterior_mean_coef1, t, x_t.shape) * x_start
-            + _extract_into_tensor(self.posterior_mean_coef2, t, x_t.shape) * x_t
+            self._extract("posterior_mean_coef1", t, x_t.shape) * x_start
+            + self._extract("posterior_mean_coef2", t, x_t.shape) * x_t
         )
-        posterior_variance = _extract_into_tensor(self.posterior_variance, t, x_t.shape)
-        posterior_log_variance_clipped = _extract_into_tensor(
-            self.posterior_log_variance_clipped, t, x_t.shape
+        posterior_variance = self._extract("posterior_variance", t, x_t.shape)
+        posterior_log_variance_clipped = self._extract(
+            "posterior_log_variance_clipped", t, x_t.shape
         )
         assert (
             posterior_mean.shape[0]
@@ -499,9 +575,9 @@ class GaussianDiffusion:
         :param t: the number of diffusion steps (minus 1). Here, 0 means one step.
         :return: A tuple (mean, variance, log_variance), all of x_start's shape.
         """
-        mean = _extract_into_tensor(self.sqrt_alphas_cumprod, t, x_start.shape) * x_start
-        variance = _extract_into_tensor(1.0 - self.alphas_cumprod, t, x_start.shape)
-        log_variance = _extract_into_tensor(self.log_one_minus_alphas_cumprod, t, x_start.shape)
+        mean = self._extract("sqrt_alphas_cumprod", t, x_start.shape) * x_start
+        variance = self._extract("one_minus_alphas_cumprod", t, x_start.shape)
+        log_variance = self._extract("log_one_minus_alphas_cumprod", t, x_start.shape)
         return mean, variance, log_variance
 
     def token_discrete_loss(self, x_t, get_logits, input_ids, mask=None):
@@ -559,16 +635,16 @@ class GaussianDiffusion:
             # for fixedlarge, we set the initial (log-)variance like so
             # to get a better decoder log likelihood.
             ModelVarType.FIXED_LARGE: (
-                np.append(self.posterior_variance[1], self.betas[1:]),
-                np.log(np.append(self.posterior_variance[1], self.betas[1:])),
+                "fixed_large_variance",
+                "fixed_large_log_variance",
             ),
             ModelVarType.FIXED_SMALL: (
-                self.posterior_variance,
-                self.posterior_log_variance_clipped,
+                "posterior_variance",
+                "posterior_log_variance_clipped",
             ),
         }[self.model_var_type]
-        model_variance = _extract_into_tensor(model_variance, t, x.shape)
-        model_log_variance = _extract_into_tensor(model_log_variance, t, x.shape)
+        model_variance = self._extract(model_variance, t, x.shape)
+        model_log_variance = self._extract(model_log_variance, t, x.shape)
 
         def process_xstart(x):
             if denoised_fn is not None:
@@ -604,30 +680,48 @@ class GaussianDiffusion:
     def _predict_xstart_from_eps(self, x_t, t, eps):
         assert x_t.shape == eps.shape
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t
-            - _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape) * eps
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t
+            - self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape) * eps
         )
 
     def _predict_xstart_from_xprev(self, x_t, t, xprev):
         assert x_t.shape == xprev.shape
         return (  # (xprev - coef2*x_t) / coef1
-            _extract_into_tensor(1.0 / self.posterior_mean_coef1, t, x_t.shape) * xprev
-            - _extract_into_tensor(
-                self.posterior_mean_coef2 / self.posterior_mean_coef1, t, x_t.shape
-            )
+            self._extract("recip_posterior_mean_coef1", t, x_t.shape) * xprev
+            - self._extract("posterior_mean_coef2_over_coef1", t, x_t.shape)
             * x_t
         )
 
     def _predict_eps_from_xstart(self, x_t, t, pred_xstart):
         return (
-            _extract_into_tensor(self.sqrt_recip_alphas_cumprod, t, x_t.shape) * x_t - pred_xstart
-        ) / _extract_into_tensor(self.sqrt_recipm1_alphas_cumprod, t, x_t.shape)
+            self._extract("sqrt_recip_alphas_cumprod", t, x_t.shape) * x_t - pred_xstart
+        ) / self._extract("sqrt_recipm1_alphas_cumprod", t, x_t.shape)
 
     def _scale_timesteps(self, t):
         if self.rescale_timesteps:
             return t.float() * (1000.0 / self.num_timesteps)
         return t
 
+    @staticmethod
+    def _noise_like(x, top_p=None, out=None):
+        """
+        Standard normal noise shaped like `x`, truncated to [-top_p, top_p] if top_p > 0.
+        The truncated normal is drawn by inverse CDF from a uniform over
+        [cdf(-top_p), cdf(top_p)], the same distribution as redrawing the entries
+        outside the range until none is left, but in a fixed number of kernels.
+        If `out` is given, the noise is drawn into it in place.
+        """
+        if top_p is not None and top_p > 0:
+            # print('top_p sampling')
+            bound = math.erf(top_p / math.sqrt(2.0))  # 2 * cdf(top_p) - 1
+            if out is not None:
+                return out.uniform_().mul_(2).sub_(1).mul_(bound).erfinv_().mul_(math.sqrt(2.0)).clamp_(-top_p, top_p)
+            u = (th.rand_like(x) * 2 - 1) * bound
+            return (math.sqrt(2.0) * th.erfinv(u)).clamp_(-top_p, top_p)
+        if out is not None:
+            return out.normal_()
+        return th.randn_like(x)
+
     def p_sample(
         self,
         model,
@@ -661,17 +755,7 @@ class GaussianDiffusion:
             denoised_fn=denoised_fn,
             model_kwargs=model_kwargs,
         )
-        if top_p is not None and top_p > 0:
-            # print('top_p sampling')
-            noise = th.randn_like(x)
-            replace_mask = th.abs(noise) > top_p
-            while replace_mask.any():
-                noise[replace_mask] = th.randn_like(noise[replace_mask])
-                replace_mask = th.abs(noise) > top_p
-            assert (th.abs(noise) <= top_p).all()
-
-        else:
-            noise = th.randn_like(x)
+        noise = self._noise_like(x, top_p)
         nonzero_mask = (
             (t != 0).float().view(-1, *([1] * (len(x.shape) - 1)))
         )  # no noise when t == 0
@@ -683,6 +767,181 @@ class GaussianDiffusion:
             "out": out,
         }
 
+    def p_sample_fused(
+        self,
+        model,
+        x,
+        t,
+        out,
+        noise,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        top_p=None,
+    ):
+        """
+        p_sample() that writes x_{t-1} into the preallocated `out` instead of building
+        the posterior mean, the variance and the noise as new tensors: the posterior
+        coefficients and the standard deviation are gathered per row from precomputed
+        schedule tables and applied in place, with the noise drawn into `noise`.
+        Only for the START_X and EPSILON mean types.
+
+        :param out: a buffer shaped like `x` (and not `x` itself) that receives x_{t-1}.
+        :param noise: a buffer shaped like `x` for the noise of this step.
+        :return: a dict with the keys 'sample' (which is `out`) and 'pred_xstart'.
+        """
+        if model_kwargs is None:
+            model_kwargs = {}
+        assert t.shape == (x.size(0),)
+        assert self.model_mean_type in [ModelMeanType.START_X, ModelMeanType.EPSILON]
+        if 'loss_mask' in model_kwargs:
+            model_kwargs.pop('loss_mask')
+        if 'self_conditions' not in model_kwargs:
+            model_kwargs["self_conditions"] = th.zeros_like(x)
+
+        model_output = model(x, self._scale_timesteps(t), **model_kwargs)
+        model_kwargs["self_conditions"] = model_output
+
+        if self.model_mean_type == ModelMeanType.START_X:
+            pred_xstart = model_output
+        else:
+            pred_xstart = self._predict_xstart_from_eps(x_t=x, t=t, eps=model_output)
+        if denoised_fn is not None:
+            pred_xstart = denoised_fn(pred_xstart, t)
+        if clip_denoised:
+            pred_xstart = pred_xstart.clamp(-1, 1)
+
+        # [B] or [B x S] per-row coefficients, broadcast over the channels without expanding
+        coef1, coef2, std = (
+            _gather_rows(self._schedule(name, x.device), t, x.dim())
+            for name in ("posterior_mean_coef1", "posterior_mean_coef2", "sample_std")
+        )
+        th.mul(pred_xstart, coef1, out=out)
+        out.addcmul_(x, coef2)
+        out.addcmul_(self._noise_like(x, top_p, out=noise), std)
+        return {"sample": out, "pred_xstart": pred_xstart}
+
+    def _wrap_model(self, model):
+        return model
+
+    def _step_coefficients(self, t, ndim):
+        """
+        The schedule rows the ancestral step at `t` needs, shaped to broadcast against an
+        `ndim`-dimensional sample: the posterior coefficients and the noise std, and for
+        EPSILON models the two factors recovering x_0 from the noise prediction.
+        """
+        names = ("posterior_mean_coef1", "posterior_mean_coef2", "sample_std")
+        if self.model_mean_type == ModelMeanType.EPSILON:
+            names += ("sqrt_recip_alphas_cumprod", "sqrt_recipm1_alphas_cumprod")
+        return tuple(_gather_rows(self._schedule(name, t.device), t, ndim) for name in names)
+
+    def sample_step_fn(self, model, clip_denoised=True, denoised_fn=None, compile=False):
+        """
+        The ancestral step of p_sample() as a function without side effects, for
+        torch.compile:
+
+            step(x, t, noise, self_conditions, model_kwargs, coefficients)
+                -> (x_{t-1}, pred_xstart, model_output)
+
+        The noise and the schedule rows (see _step_coefficients) are passed in, the
+        model output comes back to be fed in as the next `self_conditions` and
+        `model_kwargs` is left untouched, so the step has no branches on the
+        diffusion's configuration, no host syncs and no mutated inputs. Only for
+        the START_X and EPSILON mean types.
+
+        :param compile: if True, return the step compiled with torch.compile for
+                        static shapes; a new batch shape compiles it again.
+        """
+        assert self.model_mean_type in [ModelMeanType.START_X, ModelMeanType.EPSILON]
+        key = (model, clip_denoised, denoised_fn, compile, self.rescale_timesteps)
+        if self._step_fn is not None and self._step_fn[0] == key:
+            return self._step_fn[1]
+        wrapped_model = self._wrap_model(model)
+        epsilon = self.model_mean_type == ModelMeanType.EPSILON
+
+        def step(x, t, noise, self_conditions, model_kwargs, coefficients):
+            model_output = wrapped_model(x, self._scale_timesteps(t), self_conditions=self_conditions, **model_kwargs)
+            if epsilon:
+                coef1, coef2, std, recip, recipm1 = coefficients
+                pred_xstart = recip * x - recipm1 * model_output
+            else:
+                coef1, coef2, std = coefficients
+                pred_xstart = model_output
+            if denoised_fn is not None:
+                pred_xstart = denoised_fn(pred_xstart, t)
+            if clip_denoised:
+                pred_xstart = pred_xstart.clamp(-1, 1)
+            return coef1 * pred_xstart + coef2 * x + std * noise, pred_xstart, model_output
+
+        if compile:
+            step = th.compile(step, dynamic=False)
+        self._step_fn = (key, step)
+        return step
+
+    def _prepare_encoder_outputs(self, model, img, model_kwargs):
+        """
+        Run the encoder once before sampling and keep its output in
+        `model_kwargs["encoder_outputs"]`, so the denoising steps only run the decoder.
+        """
+        if "encoder_outputs" in model_kwargs:
+            self._prepare_sampling_kwargs(model, img, model_kwargs)
+            return
+        t = th.tensor([10] * img.shape[0], device=img.device)
+        if 'self_conditions' not in model_kwargs:
+            model_kwargs['self_conditions'] = th.zeros_like(img)
+        # only the batched inputs, shared entries such as time_embed_table are not for the encoder
+        encoder_kwargs = {key: value for key, value in model_kwargs.items() if th.is_tensor(value)}
+        with th.no_grad():
+            model_kwargs["encoder_outputs"] = (model.forward_encoder(decoder_inputs_embeds = img, 
+                                                                    timesteps = self._scale_timesteps(t), 
+                                                                    **encoder_kwargs), )
+        model_kwargs.pop('input_ids')
+        if 'self_conditions' in model_kwargs:
+            model_kwargs.pop('self_conditions')
+        self._prepare_sampling_kwargs(model, img, model_kwargs)
+
+    def _prepare_sampling_kwargs(self, model, img, model_kwargs):
+        """
+        Let the model precompute what stays the same over the denoising steps (the
+        cross-attention keys and values, the expanded masks, the timestep embeddings),
+        see TransformerNetModel_encoder_decoder.prepare_sampling_kwargs.
+        """
+        if not hasattr(model, "prepare_sampling_kwargs"):
+            return
+        timesteps = self._model_timesteps(model, th.arange(self.num_timesteps, device=img.device))
+        with th.no_grad():
+            model.prepare_sampling_kwargs(model_kwargs, img.shape[1], timesteps)
+
+    def _model_timesteps(self, model, t):
+        """The timesteps `model` receives for the diffusion steps `t`."""
+        return self._scale_timesteps(t)
+
+    def _transition_ancestral(self, out, t):
+        return out["sample"]
+
+    def _transition_q_sample(self, out, t):
+        # noise the x_0 prediction back to t-1 instead of taking the ancestral step
+        if t[0] > 0:
+            return self.q_sample(out['pred_xstart'], t-1)
+        return out["sample"]
+
+    def _transition_mix(self, out, t, generate_by_mix_prob=0, generate_by_mix_part=1):
+        if np.random.uniform() > 1 - generate_by_mix_prob and t[0] > (1-generate_by_mix_part) * self.num_timesteps:
+            return self.q_sample(out['pred_xstart'], t-1)
+        return out["sample"]
+
+    def get_transition(self, generate_by_q=False, generate_by_mix=False, generate_by_mix_prob=0, generate_by_mix_part=1):
+        """
+        The rule choosing x_{t-1} from the p_sample output at step t: the ancestral
+        sample, the x_0 prediction noised again with q_sample, or a random mix of both.
+        """
+        if generate_by_q:
+            return self._transition_q_sample
+        if generate_by_mix:
+            return functools.partial(self._transition_mix, generate_by_mix_prob=generate_by_mix_prob,
+                                     generate_by_mix_part=generate_by_mix_part)
+        return self._transition_ancestral
+
     def p_sample_loop_progressive(
         self,
         model,
@@ -696,14 +955,31 @@ class GaussianDiffusion:
         top_p=None,
         langevin_func=None,
         decoder_inputs = None,
+        transition=None,
+        yield_every=1,
+        full_output=True,
+        fused=False,
+        compile_step=False,
     ):
         """
         Generate samples from the model and yield intermediate samples from
-        each timestep of diffusion.
-
-        Arguments are the same as p_sample_loop().
-        Returns a generator over dicts, where each dict is the return value of
-        p_sample().
+        the timesteps of diffusion.
+
+        Arguments are the same as p_sample_loop(), plus:
+
+        :param transition: a function (p_sample output, t) -> x_{t-1}, see get_transition.
+                           Defaults to the ancestral sample.
+        :param yield_every: yield every `yield_every`-th step and the last one. If None,
+                            only the last step is yielded.
+        :param full_output: if True, yield the whole p_sample() dict; otherwise only
+                            'sample', 'pred_xstart' and the timestep 't', so the mean
+                            and variance tensors of a step are freed right away.
+        :param fused: if True, take the ancestral steps with p_sample_fused() into two
+                      buffers used in turn. A yielded 'sample' is then overwritten two
+                      steps later, so this is for callers that only keep the last one.
+        :param compile_step: if True, take the ancestral steps with the compiled
+                             sample_step_fn().
+        :return: a generator over dicts.
         """
         if device is None:
             device = next(model.parameters()).device
@@ -712,6 +988,8 @@ class GaussianDiffusion:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        if transition is None:
+            transition = self._transition_ancestral
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -719,41 +997,78 @@ class GaussianDiffusion:
             from tqdm.auto import tqdm
 
             indices = tqdm(indices)
-        
-        print(model_kwargs.keys())
-        if "encoder_outputs" not in model_kwargs:
-            t = th.tensor([10] * shape[0], device=device)
-            if 'self_conditions' not in model_kwargs:
-                model_kwargs['self_conditions'] = th.zeros_like(img)
-            with th.no_grad():
-                model_kwargs["encoder_outputs"] = (model.forward_encoder(decoder_inputs_embeds = img, 
-                                                                        timesteps = self._scale_timesteps(t), 
-                                                                        **model_kwargs), )
-            model_kwargs.pop('input_ids')
-            if 'self_conditions' in model_kwargs:
-                model_kwargs.pop('self_conditions')
 
-        for i in indices:
+        self._prepare_encoder_outputs(model, img, model_kwargs)
+
+        if fused:
+            assert transition == self._transition_ancestral and not full_output
+            buffers = [th.empty_like(img), th.empty_like(img)]
+            noise_buffer = th.empty_like(img)
+        if compile_step:
+            assert transition == self._transition_ancestral and not full_output and not fused
+            step_fn = self.sample_step_fn(model, clip_denoised=clip_denoised, denoised_fn=denoised_fn, compile=True)
+            model_kwargs.pop('loss_mask', None)
+            self_conditions = model_kwargs.pop('self_conditions', None)
+            if self_conditions is None:
+                self_conditions = th.zeros_like(img)
+
+        for step, i in enumerate(indices):
             t = th.tensor([i] * shape[0], device=device)
-            
             with th.no_grad():
-                out = self.p_sample(
-                    model,
-                    img,
-                    t,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    model_kwargs=model_kwargs,
-                    top_p=top_p,
-                )
-                yield out
-                img = out["sample"]
+                if compile_step:
+                    sample, pred_xstart, self_conditions = step_fn(
+                        img, t, self._noise_like(img, top_p), self_conditions, model_kwargs,
+                        self._step_coefficients(t, img.dim()),
+                    )
+                    out = {"sample": sample, "pred_xstart": pred_xstart}
+                elif fused:
+                    out = self.p_sample_fused(
+                        model,
+                        img,
+                        t,
+                        buffers[step % 2],
+                        noise_buffer,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        model_kwargs=model_kwargs,
+                        top_p=top_p,
+                    )
+                else:
+                    out = self.p_sample(
+                        model,
+                        img,
+                        t,
+                        clip_denoised=clip_denoised,
+                        denoised_fn=denoised_fn,
+                        model_kwargs=model_kwargs,
+                        top_p=top_p,
+                    )
+                if i == 0 or (yield_every is not None and step % yield_every == 0):
+                    yield out if full_output else {"sample": out["sample"], "pred_xstart": out["pred_xstart"], "t": i}
+                img = transition(out, t)
 
-            
     def p_sample_loop_progressive_mix_sample(
         self,
         model,
         shape,
+        generate_by_mix_prob=0,
+        generate_by_mix_part=1,
+        **kwargs,
+    ):
+        """p_sample_loop_progressive with the generate_by_mix transition."""
+        transition = self.get_transition(generate_by_mix=True, generate_by_mix_prob=generate_by_mix_prob,
+                                         generate_by_mix_part=generate_by_mix_part)
+        return self.p_sample_loop_progressive(model, shape, transition=transition, **kwargs)
+
+    def p_sample_loop_progressive_by_q_sample(self, model, shape, **kwargs):
+        """p_sample_loop_progressive with the generate_by_q transition."""
+        return self.p_sample_loop_progressive(model, shape, transition=self.get_transition(generate_by_q=True), **kwargs)
+
+    def p_sample_loop_early_exit(
+        self,
+        model,
+        shape,
+        early_exit_window,
         noise=None,
         clip_denoised=True,
         denoised_fn=None,
@@ -761,18 +1076,17 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         top_p=None,
-        langevin_func=None,
-        decoder_inputs = None,
-        generate_by_mix_prob=0,
-        generate_by_mix_part=1,
+        transition=None,
     ):
         """
-        Generate samples from the model and yield intermediate samples from
-        each timestep of diffusion.
+        p_sample_loop() that retires a row once the argmax tokens of
+        `model.get_logits(pred_xstart)` have not changed for `early_exit_window`
+        consecutive steps. A retired row returns that x_0 prediction, and the rows
+        still running are compacted into a smaller batch, together with every
+        batched tensor in `model_kwargs`, for the rest of the loop.
 
-        Arguments are the same as p_sample_loop().
-        Returns a generator over dicts, where each dict is the return value of
-        p_sample().
+        :param early_exit_window: the number of unchanged steps after which a row stops.
+        :return: a non-differentiable batch of samples.
         """
         if device is None:
             device = next(model.parameters()).device
@@ -781,6 +1095,8 @@ class GaussianDiffusion:
             img = noise
         else:
             img = th.randn(*shape, device=device)
+        if transition is None:
+            transition = self._transition_ancestral
         indices = list(range(self.num_timesteps))[::-1]
 
         if progress:
@@ -788,24 +1104,16 @@ class GaussianDiffusion:
             from tqdm.auto import tqdm
 
             indices = tqdm(indices)
-    
-        print(model_kwargs.keys())
 
-        if "encoder_outputs" not in model_kwargs:
-            t = th.tensor([10] * shape[0], device=device)
-            if 'self_conditions' not in model_kwargs:
-                model_kwargs['self_conditions'] = th.zeros_like(img)
-            with th.no_grad():
-                model_kwargs["encoder_outputs"] = (model.forward_encoder(decoder_inputs_embeds = img, 
-                                                                        timesteps = self._scale_timesteps(t), 
-                                                                        **model_kwargs), )
-            model_kwargs.pop('input_ids')
-            if 'self_conditions' in model_kwargs:
-                model_kwargs.pop('self_conditions')
-        
-        for i in indices:
-            t = th.tensor([i] * shape[0], device=device)
+        self._prepare_encoder_outputs(model, img, model_kwargs)
 
+        final = th.empty_like(img)
+        active = th.arange(shape[0], device=device)
+        prev_tokens = None
+        stable_steps = th.zeros(shape[0], dtype=th.long, device=device)
+        row_steps = 0
+        for i in indices:
+            t = th.tensor([i] * len(active), device=device)
             with th.no_grad():
                 out = self.p_sample(
                     model,
@@ -816,13 +1124,176 @@ class GaussianDiffusion:
                     model_kwargs=model_kwargs,
                     top_p=top_p,
                 )
-                yield out
-                if np.random.uniform() > 1 - generate_by_mix_prob and t[0] > (1-generate_by_mix_part) * self.num_timesteps:
-                    img = self.q_sample(out['pred_xstart'], t-1)
+                row_steps += len(active)
+                if i == 0:
+                    final[active] = out["sample"]
+                    break
+                tokens = model.get_logits(out["pred_xstart"]).argmax(dim=-1)
+                if prev_tokens is not None:
+                    unchanged = tokens == prev_tokens
+                    if "decoder_attention_mask" in model_kwargs:
+                        # padding positions are overwritten after decoding, ignore them
+                        unchanged |= model_kwargs["decoder_attention_mask"] == 0
+                    stable_steps = th.where(unchanged.all(dim=-1), stable_steps + 1, th.zeros_like(stable_steps))
+                prev_tokens = tokens
+                img = transition(out, t)
+
+                converged = stable_steps >= early_exit_window
+                if converged.any():
+                    final[active[converged]] = out["pred_xstart"][converged]
+                    keep = ~converged
+                    if not keep.any():
+                        break
+                    active, img, prev_tokens, stable_steps = active[keep], img[keep], prev_tokens[keep], stable_steps[keep]
+                    _select_rows(model_kwargs, keep)
+
+        print(f"early exit: {row_steps} of {shape[0] * self.num_timesteps} row steps run")
+        return final
+
+    def p_sample_loop_continuous(
+        self,
+        model,
+        requests,
+        batch_size,
+        row_shape,
+        clip_denoised=True,
+        denoised_fn=None,
+        device=None,
+        top_p=None,
+    ):
+        """
+        Sample a stream of requests with continuous batching. Every slot of the batch
+        holds one request at its own timestep, with its own encoder output cached in
+        `encoder_outputs`. A slot whose request reaches t = 0 is handed back and
+        refilled from `requests` right away, so the batch stays full until the
+        stream runs dry, after which it shrinks to the slots still running.
+
+        :param requests: an iterable of (request_id, {"input_ids", "attention_mask"})
+                         pairs with 1-D source tensors of any length.
+        :param batch_size: the number of slots.
+        :param row_shape: the (seq_len, channels) shape of one sample.
+        :return: a generator over (request_id, sample) pairs, in completion order.
+        """
+        if device is None:
+            device = next(model.parameters()).device
+        requests = iter(requests)
+        img = th.empty((0,) + tuple(row_shape), device=device)
+        t = th.empty((0,), dtype=th.long, device=device)
+        request_ids = []
+        model_kwargs = {}
+        while True:
+            new_rows = [r for _, r in zip(range(batch_size - len(request_ids)), requests)]
+            if new_rows:
+                new_img, new_kwargs = self._start_requests(model, new_rows, row_shape, device, model_kwargs)
+                if request_ids:
+                    model_kwargs = _concat_rows(model_kwargs, new_kwargs)
+                    self._prepare_sampling_kwargs(model, new_img, model_kwargs)
                 else:
-                    img = out["sample"]
-            
-    def p_sample_loop_progressive_by_q_sample(
+                    model_kwargs = new_kwargs
+                img = th.cat((img, new_img))
+                t = th.cat((t, th.full((len(new_rows),), self.num_timesteps - 1, dtype=th.long, device=device)))
+                request_ids.extend(request_id for request_id, _ in new_rows)
+            if not request_ids:
+                return
+
+            with th.no_grad():
+                out = self.p_sample(
+                    model,
+                    img,
+                    t,
+                    clip_denoised=clip_denoised,
+                    denoised_fn=denoised_fn,
+                    model_kwargs=model_kwargs,
+                    top_p=top_p,
+                )
+            img = out["sample"]
+            done = t == 0
+            if done.any():
+                for row in done.nonzero().flatten().tolist():
+                    yield request_ids[row], img[row]
+                keep = ~done
+                img, t = img[keep], t[keep]
+                request_ids = [r for r, k in zip(request_ids, keep.tolist()) if k]
+                _select_rows(model_kwargs, keep)
+            t = t - 1
+
+    def _start_requests(self, model, new_rows, row_shape, device, model_kwargs):
+        """
+        Fresh noise and batched model_kwargs for the requests `new_rows`, with their
+        encoder outputs computed in one pass and self-conditioning starting from zero.
+        Entries of the running `model_kwargs` that are shared by all rows are reused.
+        """
+        img = th.randn((len(new_rows),) + tuple(row_shape), device=device)
+        width = max(len(r["input_ids"]) for _, r in new_rows)
+        input_ids = th.full((len(new_rows), width), self.pad_tok_id, dtype=th.long, device=device)
+        attention_mask = th.zeros((len(new_rows), width), dtype=th.long, device=device)
+        for row, (_, r) in enumerate(new_rows):
+            input_ids[row, : len(r["input_ids"])] = r["input_ids"]
+            attention_mask[row, : len(r["attention_mask"])] = r["attention_mask"]
+        shared = {key: value for key, value in model_kwargs.items() if isinstance(value, dict)}
+        model_kwargs = {"input_ids": input_ids, "attention_mask": attention_mask, **shared}
+        self._prepare_encoder_outputs(model, img, model_kwargs)
+        model_kwargs["self_conditions"] = th.zeros_like(img)
+        return img, model_kwargs
+
+    def ddim_sample(
+        self,
+        model,
+        x,
+        t,
+        t_prev,
+        clip_denoised=True,
+        denoised_fn=None,
+        model_kwargs=None,
+        eta=0.0,
+        top_p=None,
+    ):
+        """
+        Jump from x_t straight to x_{t_prev} with the DDIM update. Both alphas are read
+        per token from the 2-D `alphas_cumprod`, so every token follows its own learned
+        schedule across the jump, exactly as q_sample would noise it at t_prev.
+
+        :param t: the current timesteps, a 1-D tensor.
+        :param t_prev: the timesteps to jump to, a 1-D tensor; -1 means x_0.
+        :param eta: the stochasticity of the jump, 0 is the deterministic DDIM sampler
+                    and 1 matches the ancestral posterior variance for one-step jumps.
+        :return: a dict with 'sample' and 'pred_xstart', like p_sample().
+        """
+        out = self.p_mean_variance(
+            model,
+            x,
+            t,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+        )
+        eps = self._predict_eps_from_xstart(x, t, out["pred_xstart"])
+        alpha_bar = self._extract("alphas_cumprod", t, x.shape)
+        alpha_bar_prev = self._extract("alphas_cumprod", t_prev.clamp(min=0), x.shape)
+        final = (t_prev < 0).view(-1, *([1] * (len(x.shape) - 1)))
+        alpha_bar_prev = th.where(final, th.ones_like(alpha_bar_prev), alpha_bar_prev)
+        sigma = (
+            eta
+            * th.sqrt((1 - alpha_bar_prev) / (1 - alpha_bar))
+            * th.sqrt((1 - alpha_bar / alpha_bar_prev).clamp(min=0))
+        )
+        mean = (
+            out["pred_xstart"] * th.sqrt(alpha_bar_prev)
+            + th.sqrt((1 - alpha_bar_prev - sigma ** 2).clamp(min=0)) * eps
+        )
+        if eta > 0:
+            mean = mean + (~final).float() * sigma * self._noise_like(x, top_p)
+        return {"sample": mean, "pred_xstart": out["pred_xstart"]}
+
+    def ddim_timesteps(self, ddim_steps):
+        """
+        `ddim_steps` timesteps spread evenly over [num_timesteps - 1, 0], in sampling
+        order. The last one is always 0, so the final jump lands on x_0.
+        """
+        steps = np.linspace(self.num_timesteps - 1, 0, min(ddim_steps, self.num_timesteps))
+        return list(dict.fromkeys(int(round(i)) for i in steps))
+
+    def ddim_sample_loop_progressive(
         self,
         model,
         shape,
@@ -833,16 +1304,17 @@ class GaussianDiffusion:
         device=None,
         progress=False,
         top_p=None,
-        langevin_func=None,
-        decoder_inputs = None,
+        ddim_steps=100,
+        timesteps=None,
+        eta=0.0,
+        yield_every=1,
     ):
         """
-        Generate samples from the model and yield intermediate samples from
-        each timestep of diffusion.
+        Like p_sample_loop_progressive(), but only visits `timesteps` (a decreasing
+        list of timesteps, ddim_timesteps(ddim_steps) by default) and jumps between
+        them with ddim_sample().
 
-        Arguments are the same as p_sample_loop().
-        Returns a generator over dicts, where each dict is the return value of
-        p_sample().
+        :return: a generator over dicts with 'sample', 'pred_xstart' and 't'.
         """
         if device is None:
             device = next(model.parameters()).device
@@ -851,44 +1323,38 @@ class GaussianDiffusion:
             img = noise
         else:
             img = th.randn(*shape, device=device)
-        indices = list(range(self.num_timesteps))[::-1]
+        if timesteps is None:
+            timesteps = self.ddim_timesteps(ddim_steps)
+        assert all(a > b for a, b in zip(timesteps, timesteps[1:])), "timesteps must be decreasing"
+        pairs = list(zip(timesteps, list(timesteps[1:]) + [-1]))
 
         if progress:
             # Lazy import so that we don't depend on tqdm.
             from tqdm.auto import tqdm
 
-            indices = tqdm(indices)
+            pairs = tqdm(pairs)
 
-        if "encoder_outputs" not in model_kwargs:
-            t = th.tensor([10] * shape[0], device=device)
-            if 'self_conditions' not in model_kwargs:
-                model_kwargs['self_conditions'] = th.zeros_like(img)
-            with th.no_grad():
-                model_kwargs["encoder_outputs"] = (model.forward_encoder(decoder_inputs_embeds = img, 
-                                                                        timesteps = self._scale_timesteps(t), 
-                                                                        **model_kwargs), )
-            model_kwargs.pop('input_ids')
-            if 'self_conditions' in model_kwargs:
-                model_kwargs.pop('self_conditions')
-        
-        for i in indices:
+        self._prepare_encoder_outputs(model, img, model_kwargs)
+
+        for step, (i, i_prev) in enumerate(pairs):
             t = th.tensor([i] * shape[0], device=device)
+            t_prev = th.tensor([i_prev] * shape[0], device=device)
             with th.no_grad():
-                out = self.p_sample(
+                out = self.ddim_sample(
                     model,
                     img,
                     t,
+                    t_prev,
                     clip_denoised=clip_denoised,
                     denoised_fn=denoised_fn,
                     model_kwargs=model_kwargs,
+                    eta=eta,
                     top_p=top_p,
                 )
-                yield out
-                if i > 0:
-                    img = self.q_sample(out['pred_xstart'], t-1)
-                else:
-                    img = out["sample"]
-            
+                if i_prev < 0 or (yield_every is not None and step % yield_every == 0):
+                    yield {"sample": out["sample"], "pred_xstart": out["pred_xstart"], "t": i}
+                img = out["sample"]
+
     def p_sample_loop(
         self,
         model,
@@ -910,6 +1376,12 @@ class GaussianDiffusion:
         generate_by_mix=False,
         generate_by_mix_prob=0,
         generate_by_mix_part=0,
+        use_ddim=False,
+        ddim_steps=100,
+        ddim_eta=0.0,
+        early_exit_window=0,
+        compile_step=False,
+        fused_step=False,
     ):
         """
         Generate samples from the model.
@@ -926,61 +1398,85 @@ class GaussianDiffusion:
         :param device: if specified, the device to create the samples on.
                        If not specified, use a model parameter's device.
         :param progress: if True, show a tqdm progress bar.
+        :param use_ddim: if True, sample with ddim_sample_loop_progressive() in
+                         `ddim_steps` jumps with stochasticity `ddim_eta`.
+        :param early_exit_window: if > 0, sample with p_sample_loop_early_exit() and
+                                  retire rows whose tokens are stable for that many steps.
+        :param compile_step: if True, run the ancestral steps through torch.compile,
+                             see sample_step_fn().
+        :param fused_step: if True, take the ancestral steps in place into preallocated
+                           buffers, see p_sample_fused().
         :return: a non-differentiable batch of samples.
         """
         final = None
-
-        if generate_by_q:
-            loop_fn = self.p_sample_loop_progressive_by_q_sample
-        
-        elif generate_by_mix:
-
-            loop_fn = self.p_sample_loop_progressive_mix_sample
-
-        else:
-            loop_fn = self.p_sample_loop_progressive
-            
-        if generate_by_mix:
-            for i, sample in enumerate(
-                loop_fn(
-                    model,
-                    shape,
-                    noise=noise,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    model_kwargs=model_kwargs,
-                    device=device,
-                    progress=progress,
-                    top_p=top_p,
-                    langevin_func=langevin_fn,
-                    decoder_inputs=decoder_inputs,
-                    generate_by_mix_part=generate_by_mix_part,
-                    generate_by_mix_prob=generate_by_mix_prob,
-                )
+        if use_ddim and early_exit_window > 0:
+            raise ValueError("early_exit_window is only supported by the ancestral sampler")
+        # both take their noise scale from the FIXED_* variance tables, see _sample_std
+        fixed_var = self.model_var_type in (ModelVarType.FIXED_SMALL, ModelVarType.FIXED_LARGE)
+        if compile_step and (use_ddim or early_exit_window > 0 or generate_by_q or generate_by_mix
+                             or self.model_mean_type == ModelMeanType.PREVIOUS_X or not fixed_var):
+            raise ValueError("compile_step (--compile_step) is only supported by the ancestral sampler of "
+                             "START_X and EPSILON models with a fixed variance")
+        if fused_step and (compile_step or use_ddim or early_exit_window > 0 or generate_by_q or generate_by_mix
+                           or self.model_mean_type == ModelMeanType.PREVIOUS_X or not fixed_var):
+            raise ValueError("fused_step (--fused_step) is only supported by the ancestral sampler of "
+                             "START_X and EPSILON models with a fixed variance")
+        if use_ddim:
+            for sample in self.ddim_sample_loop_progressive(
+                model,
+                shape,
+                noise=noise,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                model_kwargs=model_kwargs,
+                device=device,
+                progress=progress,
+                top_p=top_p,
+                ddim_steps=ddim_steps,
+                eta=ddim_eta,
+                yield_every=None,
             ):
                 final = sample
-
             return final["sample"]
-        
-        else:
-            for i, sample in enumerate(
-                loop_fn(
-                    model,
-                    shape,
-                    noise=noise,
-                    clip_denoised=clip_denoised,
-                    denoised_fn=denoised_fn,
-                    model_kwargs=model_kwargs,
-                    device=device,
-                    progress=progress,
-                    top_p=top_p,
-                    langevin_func=langevin_fn,
-                    decoder_inputs=decoder_inputs,
-                )
-            ):
-                final = sample
 
-            return final["sample"]
+        transition = self.get_transition(generate_by_q=generate_by_q, generate_by_mix=generate_by_mix,
+                                         generate_by_mix_prob=generate_by_mix_prob,
+                                         generate_by_mix_part=generate_by_mix_part)
+        if early_exit_window > 0:
+            return self.p_sample_loop_early_exit(
+                model,
+                shape,
+                early_exit_window,
+                noise=noise,
+                clip_denoised=clip_denoised,
+                denoised_fn=denoised_fn,
+                model_kwargs=model_kwargs,
+                device=device,
+                progress=progress,
+                top_p=top_p,
+                transition=transition,
+            )
+        for sample in self.p_sample_loop_progressive(
+            model,
+            shape,
+            noise=noise,
+            clip_denoised=clip_denoised,
+            denoised_fn=denoised_fn,
+            model_kwargs=model_kwargs,
+            device=device,
+            progress=progress,
+            top_p=top_p,
+            langevin_func=langevin_fn,
+            decoder_inputs=decoder_inputs,
+            transition=transition,
+            yield_every=None,
+            full_output=False,
+            fused=fused_step,
+            compile_step=compile_step,
+        ):
+            final = sample
+
+        return final["sample"]
 
     def _vb_terms_bpd_e2e(
         self,
@@ -1088,8 +1584,8 @@ class GaussianDiffusion:
 
         x_start_mean = model.get_embeds(input_ids)
 
-        std = _extract_into_tensor(
-            self.sqrt_one_minus_alphas_cumprod,
+        std = self._extract(
+            "sqrt_one_minus_alphas_cumprod",
             th.tensor([0]).to(x_start_mean.device),
             x_start_mean.shape,
         )
@@ -1135,17 +1631,94 @@ class GaussianDiffusion:
         return mse_logger, nll_logger, kl_logger
 
 
+def _interp_columns(x, xp, fp):
+    """
+    np.interp(x[:, s], xp[:, s], fp[:, s]) for every column s at once; every
+    column of `xp` must be increasing.
+    """
+    x, xp, fp = (th.from_numpy(np.ascontiguousarray(a.T, dtype=np.float64)) for a in (x, xp, fp))
+    idx = th.searchsorted(xp, x, right=True).clamp_(1, xp.shape[1] - 1)
+    x0, x1 = xp.gather(1, idx - 1), xp.gather(1, idx)
+    f0, f1 = fp.gather(1, idx - 1), fp.gather(1, idx)
+    w = ((x - x0) / (x1 - x0)).clamp_(0, 1)
+    return (f0 + w * (f1 - f0)).T.numpy()
+
+
+def _select_rows(model_kwargs, keep):
+    """
+    Keep the rows `keep` (a boolean mask over the batch) of every tensor in
+    `model_kwargs`, including the tensors inside (nested) tuples such as
+    encoder_outputs and cross_attn_key_values.
+    """
+    def select(value):
+        if th.is_tensor(value):
+            return value[keep]
+        if isinstance(value, tuple):
+            return tuple(select(v) for v in value)
+        return value
+
+    for key, value in model_kwargs.items():
+        model_kwargs[key] = select(value)
+
+
+def _concat_rows(model_kwargs, new_kwargs):
+    """
+    Append the rows of `new_kwargs` to `model_kwargs`. Source-side tensors
+    (attention_mask, encoder_outputs and cross_attn_key_values) are zero-padded to
+    the longer of the two source lengths; a zero attention_mask keeps the padding
+    out of cross-attention.
+    """
+    def pad_to(x, width, dim=1):
+        if x.shape[dim] == width:
+            return x
+        padding = list(x.shape)
+        padding[dim] = width - x.shape[dim]
+        return th.cat((x, x.new_zeros(padding)), dim=dim)
+
+    width = max(model_kwargs["attention_mask"].shape[1], new_kwargs["attention_mask"].shape[1])
+    merged = {}
+    for key, value in model_kwargs.items():
+        if key == "encoder_outputs":
+            merged[key] = tuple(th.cat((pad_to(a, width), pad_to(b, width))) for a, b in zip(value, new_kwargs[key]))
+        elif key == "cross_attn_key_values":
+            # one (key, value) pair per decoder layer, batch x heads x source length x head dim
+            merged[key] = tuple(
+                tuple(th.cat((pad_to(a, width, dim=2), pad_to(b, width, dim=2))) for a, b in zip(layer, new_layer))
+                for layer, new_layer in zip(value, new_kwargs[key])
+            )
+        elif key == "attention_mask":
+            merged[key] = th.cat((pad_to(value, width), pad_to(new_kwargs[key], width)))
+        elif key == "encoder_attention_mask":
+            continue  # expanded from attention_mask again by _prepare_sampling_kwargs
+        elif isinstance(value, dict):
+            merged[key] = value  # shared by all rows
+        else:
+            merged[key] = th.cat((value, new_kwargs[key]))
+    return merged
+
+
+def _gather_rows(table, timesteps, ndim):
+    """
+    Rows `timesteps` of a [T] or [T x S] schedule table, with trailing singleton
+    dimensions up to `ndim` so they broadcast against the batch without being expanded.
+    """
+    rows = table[timesteps]
+    return rows.view(*rows.shape, *([1] * (ndim - rows.dim())))
+
+
 def _extract_into_tensor(arr, timesteps, broadcast_shape):
     """
-    Extract values from a 1-D numpy array for a batch of indices.
+    Extract values from a numpy array or tensor for a batch of indices.
 
-    :param arr: the 1-D numpy array.
+    :param arr: the numpy array or tensor, indexed along its first dimension.
     :param timesteps: a tensor of indices into the array to extract.
     :param broadcast_shape: a larger shape of K dimensions with the batch
                             dimension equal to the length of timesteps.
     :return: a tensor of shape [batch_size, 1, ...] where the shape has K dims.
     """
-    res = th.from_numpy(arr).to(device=timesteps.device)[timesteps].float()
+    if isinstance(arr, np.ndarray):
+        arr = th.from_numpy(arr).to(device=timesteps.device)
+    res = arr[timesteps].float()
     while len(res.shape) < len(broadcast_shape):
         res = res[..., None]
     return res.expand(broadcast_shape)
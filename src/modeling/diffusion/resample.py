@@ -99,8 +99,13 @@ class LossAwareSampler(ScheduleSampler):
 
         timestep_batches = [th.zeros(max_bs).to(local_ts) for bs in batch_sizes]
         loss_batches = [th.zeros(max_bs).to(local_losses) for bs in batch_sizes]
-        dist.all_gather(timestep_batches, local_ts)
-        dist.all_gather(loss_batches, local_losses)
+        # all_gather needs the same shape on every rank
+        padded_ts = th.zeros(max_bs).to(local_ts)
+        padded_ts[: len(local_ts)] = local_ts
+        padded_losses = th.zeros(max_bs).to(local_losses)
+        padded_losses[: len(local_losses)] = local_losses
+        dist.all_gather(timestep_batches, padded_ts)
+        dist.all_gather(loss_batches, padded_losses)
         timesteps = [
             x.item() for y, bs in zip(timestep_batches, batch_sizes) for x in y[:bs]
         ]
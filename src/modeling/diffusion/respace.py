@@ -74,7 +74,8 @@ class SpacedDiffusion(GaussianDiffusion):
         self.timestep_map = []
         self.original_num_steps = len(kwargs["betas"])
         base_diffusion = GaussianDiffusion(**kwargs)  # pylint: disable=missing-kwoa
-        last_alpha_cumprod = 1.0
+        # alphas_cumprod is T x S (one schedule per token), so every step below is a row
+        last_alpha_cumprod = np.ones_like(base_diffusion.alphas_cumprod[0])
         new_betas = []
         for i, alpha_cumprod in enumerate(base_diffusion.alphas_cumprod):
             if i in self.use_timesteps:
@@ -83,6 +84,28 @@ class SpacedDiffusion(GaussianDiffusion):
                 self.timestep_map.append(i)
         kwargs["betas"] = np.array(new_betas)
         super().__init__(**kwargs)
+        self._wrapped_model = None
+
+    def _load_time_schedule(self, path):
+        """
+        Load a T x S `alpha_cumprod_step_*.npy` saved by training. A schedule over the
+        original `original_num_steps` steps is cut down to the retained rows, which
+        gives the same per-token alpha_bar at every retained step; a schedule that
+        already has one row per spaced step is used as it is.
+        """
+        alphas_cumprod = np.load(path)
+        if alphas_cumprod.ndim != 2 or alphas_cumprod.shape[1] != self.token_max_length:
+            raise ValueError(
+                f"expected a (steps, {self.token_max_length}) schedule in {path}, got {alphas_cumprod.shape}"
+            )
+        if alphas_cumprod.shape[0] == self.original_num_steps:
+            alphas_cumprod = alphas_cumprod[self.timestep_map]
+        elif alphas_cumprod.shape[0] != self.num_timesteps:
+            raise ValueError(
+                f"the schedule in {path} has {alphas_cumprod.shape[0]} steps, "
+                f"expected {self.original_num_steps} or {self.num_timesteps}"
+            )
+        self.update_time_discretized_parameters(alphas_cumprod)
 
     def p_mean_variance(
         self, model, *args, **kwargs
@@ -91,6 +114,11 @@ class SpacedDiffusion(GaussianDiffusion):
         # print(kwargs.keys())
         return super().p_mean_variance(self._wrap_model(model), *args, **kwargs)
     
+    def p_sample_fused(
+        self, model, *args, **kwargs
+    ):  # pylint: disable=signature-differs
+        return super().p_sample_fused(self._wrap_model(model), *args, **kwargs)
+
     def training_losses(
         self, model, *args, **kwargs
     ):  # pylint: disable=signature-differs
@@ -100,9 +128,16 @@ class SpacedDiffusion(GaussianDiffusion):
     def _wrap_model(self, model):
         if isinstance(model, _WrappedModel_encoder_decoder):
             return model
-        return _WrappedModel_encoder_decoder(
-            model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
-        )
+        # kept between calls, so the wrapper's timestep_map tensor is built once per device
+        if self._wrapped_model is None or self._wrapped_model.model is not model \
+                or self._wrapped_model.rescale_timesteps != self.rescale_timesteps:
+            self._wrapped_model = _WrappedModel_encoder_decoder(
+                model, self.timestep_map, self.rescale_timesteps, self.original_num_steps
+            )
+        return self._wrapped_model
+
+    def _model_timesteps(self, model, t):
+        return self._wrap_model(model).model_timesteps(t)
 
     def _scale_timesteps(self, t):
         # Scaling is done by the wrapped model.
@@ -114,11 +149,18 @@ class _WrappedModel_encoder_decoder:
         self.timestep_map = timestep_map
         self.rescale_timesteps = rescale_timesteps
         self.original_num_steps = original_num_steps
+        self._map_tensors = {}
 
-    def __call__(self, x, ts, **kwargs):
-        map_tensor = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
-        new_ts = map_tensor[ts]
+    def model_timesteps(self, ts):
+        """The timesteps of the original process that the spaced timesteps `ts` stand for, rescaled."""
+        key = (ts.device, ts.dtype)
+        if key not in self._map_tensors:
+            self._map_tensors[key] = th.tensor(self.timestep_map, device=ts.device, dtype=ts.dtype)
+        new_ts = self._map_tensors[key][ts]
         if self.rescale_timesteps:
             new_ts = new_ts.float() * (1000.0 / self.original_num_steps)
-        return self.model(decoder_inputs_embeds = x, timesteps = new_ts, **kwargs)
+        return new_ts
+
+    def __call__(self, x, ts, **kwargs):
+        return self.model(decoder_inputs_embeds = x, timesteps = self.model_timesteps(ts), **kwargs)
 
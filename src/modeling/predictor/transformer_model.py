@@ -1,5 +1,5 @@
 from transformers import AutoConfig
-from modeling_bart import BartModel
+from modeling_bart import BartModel, _expand_mask
 import torch
 import torch as th
 import torch.nn as nn
@@ -158,41 +158,54 @@ class TransformerNetModel_encoder_decoder(nn.Module):
                 self_conditions = None,
                 ):
         """
-        Apply the model to an input batch.
+        Run only the encoder of `input_transformers` on the source tokens. The
+        decoder-side arguments are accepted so that the sampling model_kwargs can be
+        passed as they are, but the encoder does not depend on them.
 
-        :param x: an [N x C x ...] Tensor of inputs.
-        :param timesteps: a 1-D batch of timesteps.
-        :param y: an [N] Tensor of labels, if class-conditional.
-        :return: an [N x C x ...] Tensor of outputs.
+        :param input_ids: an [N x L] Tensor of source token ids.
+        :param attention_mask: an [N x L] mask of the source tokens.
+        :return: the [N x L x H] last hidden state of the encoder, to be passed to
+                 forward() as `encoder_outputs=(hidden_state,)`.
         """
-        
-        emb = self.time_embed(timestep_embedding(timesteps, self.in_channels))
-        seq_length = decoder_inputs_embeds.size(1)
-        if len(emb.shape) < 3:
-            emb = emb.unsqueeze(1).expand(-1, seq_length, -1)
-        # decoder_inputs_embeds = self.input_transformers.decoder.embed_tokens(decoder_input_ids) * self.embed_scale
-        if self_conditions is not None:
-            
-            decoder_inputs_embeds = th.concat((decoder_inputs_embeds, self_conditions), dim = -1)
-
-        decoder_inputs_embeds = (
-            self.input_up_proj_dec(decoder_inputs_embeds)
-            + emb
-        )
-        emb_inputs = self.dropout(self.LayerNorm(decoder_inputs_embeds))
-        
-        encoder_hidden_states = self.input_transformers(
+        encoder_hidden_states = self.input_transformers.encoder(
             input_ids = None,
             attention_mask=attention_mask,
             inputs_embeds = self.input_up_proj_enc(self.input_transformers.encoder.embed_tokens(input_ids) * self.embed_scale),
-            decoder_input_ids=None,
-            decoder_inputs_embeds=emb_inputs, 
-            decoder_attention_mask=decoder_attention_mask,
-            output_attentions=True,
-        ).encoder_last_hidden_state
+            return_dict=True,
+        ).last_hidden_state
         
         return encoder_hidden_states
 
+    def precompute_cross_attn_key_values(self, encoder_hidden_states):
+        """
+        The cross-attention keys and values of every decoder layer for the output of
+        forward_encoder(), to pass to forward() as `cross_attn_key_values` for as long
+        as the encoder output stays the same.
+        """
+        return self.input_transformers.decoder.precompute_cross_attn_key_values(encoder_hidden_states)
+
+    def prepare_sampling_kwargs(self, model_kwargs, seq_length, timesteps):
+        """
+        Add to the sampling `model_kwargs` everything forward() would otherwise
+        recompute at every denoising step, given the encoder output in
+        model_kwargs["encoder_outputs"]. Entries that are already there are kept.
+
+        :param seq_length: the length of the samples.
+        :param timesteps: every timestep the model will be called with, increasing.
+        """
+        encoder_hidden_states = model_kwargs["encoder_outputs"][0]
+        if "cross_attn_key_values" not in model_kwargs:
+            model_kwargs["cross_attn_key_values"] = self.precompute_cross_attn_key_values(encoder_hidden_states)
+        if "encoder_attention_mask" not in model_kwargs and model_kwargs.get("attention_mask") is not None:
+            model_kwargs["encoder_attention_mask"] = _expand_mask(
+                model_kwargs["attention_mask"], encoder_hidden_states.dtype, tgt_len=seq_length)
+        if "time_embed_table" not in model_kwargs:
+            # a dict rather than a tuple: it is shared by all rows, not split with the batch
+            model_kwargs["time_embed_table"] = {
+                "timesteps": timesteps,
+                "embeddings": self.time_embed(timestep_embedding(timesteps, self.in_channels)),
+            }
+
     def forward(self, 
                 input_ids = None,
                 timesteps = None,
@@ -201,6 +214,9 @@ class TransformerNetModel_encoder_decoder(nn.Module):
                 decoder_attention_mask = None,
                 self_conditions = None,
                 encoder_outputs=None,
+                cross_attn_key_values=None,
+                encoder_attention_mask=None,
+                time_embed_table=None,
                 ):
         """
         Apply the model to an input batch.
@@ -208,10 +224,15 @@ class TransformerNetModel_encoder_decoder(nn.Module):
         :param x: an [N x C x ...] Tensor of inputs.
         :param timesteps: a 1-D batch of timesteps.
         :param y: an [N] Tensor of labels, if class-conditional.
+        :param cross_attn_key_values, encoder_attention_mask, time_embed_table:
+            step-invariant inputs precomputed by prepare_sampling_kwargs.
         :return: an [N x C x ...] Tensor of outputs.
         """
         assert encoder_outputs is None or input_ids is None
-        emb = self.time_embed(timestep_embedding(timesteps, self.in_channels))
+        if time_embed_table is not None:
+            emb = time_embed_table["embeddings"][th.searchsorted(time_embed_table["timesteps"], timesteps)]
+        else:
+            emb = self.time_embed(timestep_embedding(timesteps, self.in_channels))
         seq_length = decoder_inputs_embeds.size(1)
         if len(emb.shape) < 3:
             emb = emb.unsqueeze(1).expand(-1, seq_length, -1)
@@ -232,7 +253,9 @@ class TransformerNetModel_encoder_decoder(nn.Module):
             decoder_input_ids=None,
             decoder_inputs_embeds=emb_inputs, 
             decoder_attention_mask=decoder_attention_mask,
-            encoder_outputs=encoder_outputs
+            encoder_outputs=encoder_outputs,
+            cross_attn_key_values=cross_attn_key_values,
+            encoder_attention_mask=encoder_attention_mask,
         ).last_hidden_state
         
         h = self.output_down_proj(input_trans_hidden_states)
@@ -0,0 +1,88 @@
+"""
+T5IUPACTokenizer.encode_batch / decode_batch must give what the per-string encode and
+decode give. Skipped when the pinned transformers / sentencepiece API is not installed.
+"""
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+spm = pytest.importorskip("sentencepiece")
+try:
+    from iupac_tokenization import T5IUPACTokenizer
+except ImportError as e:  # newer transformers dropped AdamW and friends
+    pytest.skip(f"iupac_tokenization needs the pinned transformers: {e}", allow_module_level=True)
+
+
+# spaces, repeated and leading spaces, characters outside the vocabulary, empty text
+TEXTS = [
+    "2-acetyloxybenzoic acid",
+    "ethyl 2-(4-chlorophenyl)acetate",
+    "N,N-diethylethanamine",
+    "sodium;chloride",
+    "nitric acid",
+    "  2-methylpropan-1-ol",
+    "benzoic  acid ",
+    "µ-oxo-bis(€)",
+    "日本",
+    "",
+    " ",
+]
+
+
+def _tokenizer(vocab_file):
+    tokenizer = T5IUPACTokenizer(vocab_file=vocab_file)
+    if not hasattr(tokenizer, "sp_model"):
+        pytest.skip("T5Tokenizer has no sp_model in this transformers version")
+    return tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return _tokenizer(os.path.join(ROOT, "data", "iupac_spm.model"))
+
+
+@pytest.fixture(scope="module")
+def underscore_tokenizer(tmp_path_factory):
+    # the shipped vocabulary has no piece that starts or ends with "_", so "_" next to
+    # punctuation needs a model with "_" and the punctuation as pieces of their own
+    out_dir = tmp_path_factory.mktemp("spm")
+    corpus = out_dir / "corpus.txt"
+    corpus.write_text("benzoic_acid.\nnitric_acid,\nacid_'s\nacid_?\n" * 20)
+    spm.SentencePieceTrainer.train(
+        input=str(corpus), model_prefix=str(out_dir / "spm"), model_type="unigram",
+        vocab_size=30, hard_vocab_limit=False, user_defined_symbols=["_", ".", ",", "'s", "?", "acid"],
+        pad_id=0, eos_id=1, unk_id=2, bos_id=-1,
+    )
+    return _tokenizer(str(out_dir / "spm.model"))
+
+
+@pytest.mark.parametrize("num_threads", [1, 2])
+def test_encode_batch_matches_encode(tokenizer, num_threads):
+    encoded = tokenizer.encode_batch(TEXTS, num_threads=num_threads)
+    assert [encoding.ids for encoding in encoded] == [tokenizer.encode(text) for text in TEXTS]
+
+
+def test_decode_batch_matches_decode(tokenizer):
+    sequences = [encoding.ids for encoding in tokenizer.encode_batch(TEXTS)]
+    # padding and special ids in the middle of a row are dropped like in decode
+    sequences.append([0, 5, 1, 104, 2, 152, 0, 0])
+    assert tokenizer.decode_batch(sequences) == [
+        tokenizer.decode(ids, skip_special_tokens=True) for ids in sequences
+    ]
+
+
+def test_decode_batch_underscore_next_to_punctuation(underscore_tokenizer):
+    piece = underscore_tokenizer.sp_model.piece_to_id
+    sequences = [
+        [piece("acid"), piece("_"), piece(".")],
+        [piece("acid"), piece("_"), piece(",")],
+        [piece("acid"), piece("_"), piece("'s")],
+        [piece("_"), piece("?"), piece("acid"), piece("_")],
+    ]
+    assert underscore_tokenizer.decode_batch(sequences) == [
+        underscore_tokenizer.decode(ids, skip_special_tokens=True) for ids in sequences
+    ]
@@ -1,6 +1,7 @@
 import json
 import logging
 import pathlib
+import numpy as np
 import torch
 from transformers import AutoTokenizer
 import os.path as pt
@@ -23,6 +24,31 @@ def create_iupac_smiles_tokenizer(return_pretokenized, path, tokenizer_ckpt: str
     else:
         return None,None
 
+def batch_decode(tokenizer, ids, num_special_ids=3):
+    """
+    Decode a 2-D array of generated ids in one go.
+
+    Ids below `num_special_ids` (pad, bos/eos and unk for both tokenizers) are dropped
+    with a single mask over the whole array, then the rows are decoded by the
+    tokenizer's batch decoder: `decode_batch` for T5IUPACTokenizer and `tokenizers`
+    objects, the Rust backend for transformers fast tokenizers.
+    """
+    ids = np.asarray(ids)
+    keep = ids >= num_special_ids
+    flat = ids[keep].tolist()
+    ends = np.cumsum(keep.sum(axis=1)).tolist()
+    rows = [flat[start:end] for start, end in zip([0] + ends[:-1], ends)]
+
+    if hasattr(tokenizer, 'decode_batch'):
+        return tokenizer.decode_batch(rows)
+    if hasattr(tokenizer, 'backend_tokenizer'):
+        texts = tokenizer.backend_tokenizer.decode_batch(rows, skip_special_tokens=True)
+        if getattr(tokenizer, 'clean_up_tokenization_spaces', True):
+            texts = [tokenizer.clean_up_tokenization(text) for text in texts]
+        return texts
+    return tokenizer.batch_decode(rows, skip_special_tokens=True)
+
+
 def create_tokenizer(return_pretokenized, path, tokenizer_type: str = "word-level", tokenizer_ckpt: str = None):
     
     if return_pretokenized:
@@ -0,0 +1,43 @@
+#!/bin/bash
+
+# quality vs. number of sampling steps on the example/seed set:
+# the full ancestral sampler once, then the DDIM sampler at each step count in STEPS.
+#
+# bash ./train_scripts/ddim_steps_sweep.sh ema_0.9999_160000.pt alpha_cumprod_step_160000.npy "50 100 200"
+
+MODEL_DIR=./ckpts/wjm_ckpts/wjm14_128_0.0001_2000_1000000_10000_schegran20000_srciupac_tgtsmiles
+MODEL_NAME=${MODEL_DIR}/$1
+SCHEDULE_PATH=${MODEL_DIR}/${2}
+STEPS=${3:-"50 100 200"}
+DDIM_ETA=${4:-0.0}
+SEED=${5:-10708}
+VAL_TXT=./example/seed
+OUT_DIR=${MODEL_DIR}/ddim_steps_sweep_${SEED}
+
+TOP_P=-1
+CLAMP="no_clamp"
+BATCH_SIZE=50
+SEQ_LEN=128
+DIFFUSION_STEPS=2000
+NUM_SAMPLES=-1
+
+
+mkdir -p ${OUT_DIR}
+
+run() {
+    # every run writes its samples to its own file, so nothing depends on how the sampler names outputs
+    local output=${OUT_DIR}/$1.txt
+    shift
+    local start=$(date +%s)
+    python -u inference_main.py --model_name_or_path ${MODEL_NAME} --sequence_len_src 1024 \
+    --batch_size ${BATCH_SIZE} --num_samples ${NUM_SAMPLES} --top_p ${TOP_P} --time_schedule_path ${SCHEDULE_PATH} \
+    --seed ${SEED} --val_txt_path ${VAL_TXT} --generate_by_q False --generate_by_mix False \
+    --diffusion_steps ${DIFFUSION_STEPS} --clamp ${CLAMP} --sequence_len ${SEQ_LEN} --output_path ${output} "$@"
+    echo "$(basename ${output} .txt): $(( $(date +%s) - start ))s"
+    python bleu_eval.py ${output}
+}
+
+run normal --use_ddim False
+for steps in ${STEPS}; do
+    run ddim_${steps}_eta${DDIM_ETA} --use_ddim True --ddim_steps ${steps} --ddim_eta ${DDIM_ETA}
+done
@@ -51,6 +51,8 @@ class Trainer:
         eval_data=None,
         eval_interval=-1,
         warmup=None,
+        max_tokens=-1,
+        microbatch_tokens=-1,
     ):
         self.model = model
         self.diffusion = diffusion
@@ -58,6 +60,8 @@ class Trainer:
         self.eval_data = eval_data
         self.batch_size = batch_size
         self.microbatch = microbatch if microbatch > 0 else batch_size
+        self.max_tokens = max_tokens
+        self.microbatch_tokens = microbatch_tokens
         self.lr = lr
         self.ema_rate = (
             [ema_rate]
@@ -194,27 +198,75 @@ class Trainer:
 
     def run_step(self, batch, cond):
         self.forward_backward(batch, cond)
+        self.diffusion.sync_loss_history(self.step)
+        logger.logkv_mean("batch_rows", batch['input_ids'].shape[0])
         if self.use_fp16:
             self.optimize_fp16()
         else:
             self.optimize_normal()
         self.log_step()
 
+    def _microbatch_size(self, batch):
+        """
+        Rows per microbatch: `microbatch`, or as many rows as fit in `microbatch_tokens`
+        padded source+target tokens, which follows the token budget of the batch.
+        """
+        if self.microbatch_tokens <= 0:
+            return self.microbatch
+        row_tokens = batch['input_ids'].shape[1] + batch['decoder_input_ids'].shape[1]
+        return max(self.microbatch_tokens // row_tokens, 1)
+
+    def _token_batching(self):
+        return self.max_tokens > 0 or self.microbatch_tokens > 0
+
+    def _microbatch_bounds(self, batch):
+        """
+        (start, end) row ranges splitting `batch` into microbatches of at most
+        _microbatch_size rows. With --max_tokens or --microbatch_tokens the ranks can split
+        into different numbers of microbatches, so every rank splits into the largest count
+        of all ranks and the DDP gradient allreduce and the other per-microbatch
+        collectives stay aligned. A rank with fewer rows than microbatches gets empty
+        ranges, see _microbatch.
+        """
+        batch_size = batch['input_ids'].shape[0]
+        microbatch = self._microbatch_size(batch)
+        if not self._token_batching():
+            return [(i, min(i + microbatch, batch_size)) for i in range(0, batch_size, microbatch)]
+        num_micro = -(-batch_size // microbatch)
+        if dist.get_world_size() > 1:
+            num_micro = torch.tensor([num_micro], device=dist_util.dev())
+            dist.all_reduce(num_micro, op=dist.ReduceOp.MAX)
+            num_micro = int(num_micro.item())
+        bounds = [batch_size * k // num_micro for k in range(num_micro + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _microbatch(self, batch, start, end):
+        """
+        Rows [start, end) of `batch` on the device. An empty range gives a masked step that
+        only keeps the collectives in line: the first row with an all-padding target, which
+        the loss history skips and whose loss is not counted.
+        """
+        if start < end:
+            return {key: item[start:end].to(dist_util.dev()) for key, item in batch.items()}
+        micro = {key: item[:1].to(dist_util.dev()) for key, item in batch.items()}
+        micro['decoder_input_ids'] = torch.full_like(micro['decoder_input_ids'], self.diffusion.pad_tok_id)
+        return micro
+
     def forward_only(self, batch, cond):
 
-        batch_size = batch['input_ids'].shape[0]
+        bounds = self._microbatch_bounds(batch)
         with torch.no_grad():
             zero_grad(self.model_params)
-            for i in range(0, batch_size, self.microbatch):
-                micro = {key: item[i : i + self.microbatch].to(dist_util.dev()) for key, item in batch.items()}
+            for i, (start, end) in enumerate(bounds):
+                micro = self._microbatch(batch, start, end)
                 if cond == None:
                     micro_cond = None
                 else:
                     micro_cond = {
-                        k: v[i : i + self.microbatch].to(dist_util.dev())
+                        k: v[start:end].to(dist_util.dev())
                         for k, v in cond.items()
                     }
-                last_batch = (i + self.microbatch) >= batch_size
+                last_batch = i == len(bounds) - 1
                 t, weights = self.schedule_sampler.sample(micro['input_ids'].shape[0], dist_util.dev())
 
                 compute_losses = functools.partial(
@@ -231,26 +283,28 @@ class Trainer:
                     with self.ddp_model.no_sync():
                         losses = compute_losses()
 
-                log_loss_dict(
-                    self.diffusion, t, {f"eval_{k}": v * weights for k, v in losses.items()}
-                )
+                if end > start:
+                    log_loss_dict(
+                        self.diffusion, t, {f"eval_{k}": v * weights for k, v in losses.items()}
+                    )
 
 
     def forward_backward(self, batch, cond):
         # print(batch)
         batch_size = batch['input_ids'].shape[0]
+        bounds = self._microbatch_bounds(batch)
         zero_grad(self.model_params)
-        for i in range(0, batch_size, self.microbatch):
-            micro = {key: item[i : i + self.microbatch].to(dist_util.dev()) for key, item in batch.items()}
+        for i, (start, end) in enumerate(bounds):
+            micro = self._microbatch(batch, start, end)
             if cond == None:
                 micro_cond = None
             else:
                 micro_cond = {
-                    k: v[i : i + self.microbatch].to(dist_util.dev())
+                    k: v[start:end].to(dist_util.dev())
                     for k, v in cond.items()
                 }
             
-            last_batch = (i + self.microbatch) >= batch_size
+            last_batch = i == len(bounds) - 1
             t, weights = self.schedule_sampler.sample(micro['input_ids'].shape[0], dist_util.dev())
 
             compute_losses = functools.partial(
@@ -267,15 +321,23 @@ class Trainer:
                 with self.ddp_model.no_sync():
                     losses = compute_losses()
 
+            # a masked step keeps no rows: it still runs the backward for the allreduce
+            rows = end - start
             if isinstance(self.schedule_sampler, LossAwareSampler):
                 self.schedule_sampler.update_with_local_losses(
-                    t, losses["loss"].detach()
+                    t[:rows], losses["loss"][:rows].detach()
                 )
 
-            loss = (losses["loss"] * weights).mean()
-            log_loss_dict(
-                self.diffusion, t, {k: v * weights for k, v in losses.items()}
-            )
+            if self._token_batching():
+                # weighted by its share of the rows, so the gradient is the mean over the
+                # batch whatever number of microbatches it was split into
+                loss = (losses["loss"][:rows] * weights[:rows]).sum() / batch_size
+            else:
+                loss = (losses["loss"] * weights).mean()
+            if rows:
+                log_loss_dict(
+                    self.diffusion, t, {k: v * weights for k, v in losses.items()}
+                )
             if self.use_fp16:
                 loss_scale = 2 ** self.lg_loss_scale
                 (loss * loss_scale).backward()